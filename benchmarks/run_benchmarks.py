@@ -0,0 +1,216 @@
+"""
+Times gpstools pipeline stages on synthetic stages and saves results as json.
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --output results.json
+    python -m benchmarks.run_benchmarks --output new.json --compare results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.track_generator import SyntheticStageParams, DEFAULT_SYNTHETIC_STAGE_PARAMS, STOP_DURATION_SECONDS, \
+    generate_stage, write_stage
+from gpstools import viz
+from gpstools.parser import load_tracks_in_path
+from gpstools.ss_analysis.ss_analysis_graph import SSAnalysisGraph
+from gpstools.track.activity_detection import DEFAULT_ACTIVITY_DETECTION_PARAMS, get_activity_segments_for_track
+from gpstools.track.normalization import TrackNormalizationParams
+from gpstools.track.speed_calculation import calculate_speed_by_distance, calculate_speed_with_provided_data, \
+    DEFAULT_SPEED_PARAMS
+from gpstools.track.track import Track
+from gpstools.track.utils import build_sparse_track
+
+RESULTS_FORMAT_VERSION = 1
+
+BENCHMARK_NORM_PARAMS = TrackNormalizationParams(align_to_minutes=True, neighbor_weights=[0.25, 0.5, 0.25])
+SPARSE_REFERENCE_DISTANCE_KM = 0.005
+
+# Generated stops don't split stages into segments, so each crew is compared from start to finish
+BENCHMARK_ACTIVITY_DETECTION_PARAMS = DEFAULT_ACTIVITY_DETECTION_PARAMS._replace(
+    segment_max_allow_pause=2 * STOP_DURATION_SECONDS
+)
+
+
+def run_benchmarks(stage_params, frequencies, repeat):
+    """@:returns list of results for each frequency, see _run_pipeline"""
+    runs = []
+    for frequency_hz in frequencies:
+        params = stage_params._replace(frequency_hz=frequency_hz)
+        with tempfile.TemporaryDirectory() as tmp_path:
+            write_stage(generate_stage(params), tmp_path)
+            runs.append(_run_pipeline(params, tmp_path, repeat))
+
+    return runs
+
+
+def _run_pipeline(params, path, repeat):
+    """
+    Runs pipeline stages in order, each stage gets output of the previous ones and can be repeated
+    @:returns dict with stage timings (min and median of repeats) and peak traced memory of a separate run
+    """
+    stages = {}
+    state = {}
+
+    def parser():
+        state['parsed_tracks'] = load_tracks_in_path(path)
+
+    def track():
+        state['tracks'] = [
+            Track(t.name, t.points, speed_params=None, norm_params=BENCHMARK_NORM_PARAMS)
+            for t in state['parsed_tracks']
+        ]
+
+        # Track metrics are lazy, they are calculated here so their time isn't added to the next stages
+        for t in state['tracks']:
+            t.dist_from_start, t.micros_from_start, t.speed, t.max_speed, t.avg_speed
+
+    def speed_calculation():
+        for t in state['tracks']:
+            calculate_speed_with_provided_data(t.points, DEFAULT_SPEED_PARAMS.smoothing_10hz)
+            calculate_speed_by_distance(t.points, DEFAULT_SPEED_PARAMS.smoothing_10hz)
+
+    def activity_detection():
+        state['segments'] = [
+            get_activity_segments_for_track(t, BENCHMARK_ACTIVITY_DETECTION_PARAMS) for t in state['tracks']
+        ]
+
+    def ss_analysis_graph():
+        reference_track = state['tracks'][0]
+        reference = build_sparse_track(
+            reference_track.crop_to_activity_segment(state['segments'][0][0], 'reference'), SPARSE_REFERENCE_DISTANCE_KM
+        )
+        state['graph'] = SSAnalysisGraph(
+            state['tracks'], reference, activity_detection_params=BENCHMARK_ACTIVITY_DETECTION_PARAMS
+        )
+        aligned_names = set(t.name for t in state['graph'].aligned_tracks)
+        assert aligned_names == set(t.name for t in state['tracks']), \
+            "Only %d of %d crews are aligned" % (len(aligned_names), len(state['tracks']))
+
+    def viz_export():
+        graph = state['graph']
+        viz.output_ss_comparison_json(
+            os.path.join(path, 'data.json'), 'benchmark', graph.reference_track, graph.aligned_tracks,
+            graph.speed_comparison_points
+        )
+
+    for stage in [parser, track, speed_calculation, activity_detection, ss_analysis_graph, viz_export]:
+        timings = []
+        for _ in range(repeat):
+            timings.append(_measure_time(stage))
+        stages[stage.__name__] = {
+            'seconds_min': min(timings),
+            'seconds_median': float(np.median(timings)),
+            'peak_memory_bytes': _measure_peak_memory(stage)
+        }
+
+    return {
+        'params': params._asdict(),
+        'points': sum(t.len for t in state['tracks']),
+        'stages': stages
+    }
+
+
+def _measure_time(stage):
+    # Library reports progress with prints, it shouldn't be included in timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        stage()
+        return time.perf_counter() - start
+
+
+def _measure_peak_memory(stage):
+    """Separate run, tracing slows allocations down too much to be timed together"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        try:
+            stage()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return peak
+
+
+def _get_git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(runs, baseline_runs=None):
+    """Prints stage timings, with change relative to baseline run of the same frequency when given"""
+    baseline_by_frequency = {r['params']['frequency_hz']: r for r in baseline_runs or []}
+    for run in runs:
+        print('%d Hz, %d points:' % (run['params']['frequency_hz'], run['points']))
+        baseline = baseline_by_frequency.get(run['params']['frequency_hz'])
+        for name, stage in run['stages'].items():
+            line = '  %-20s %8.3f s %10.1f MB' % (name, stage['seconds_min'], stage['peak_memory_bytes'] / 1e6)
+            if baseline and name in baseline['stages']:
+                baseline_seconds = baseline['stages'][name]['seconds_min']
+                if baseline_seconds > 0:
+                    line += '  %+7.1f%%' % ((stage['seconds_min'] / baseline_seconds - 1) * 100)
+            print(line)
+
+
+def parse_args(argv):
+    defaults = DEFAULT_SYNTHETIC_STAGE_PARAMS
+    parser = argparse.ArgumentParser(description='Benchmarks gpstools pipeline stages on synthetic rally stages')
+    parser.add_argument('--output', default='benchmark_results.json', help='json file for results')
+    parser.add_argument('--compare', help='json file with previous results to compare with')
+    parser.add_argument('--frequencies', type=int, nargs='+', default=[1, 10], help='logging frequencies, Hz')
+    parser.add_argument('--length-km', type=float, default=defaults.length_km)
+    parser.add_argument('--noise-m', type=float, default=defaults.noise_m)
+    parser.add_argument('--stops', type=int, default=defaults.stops)
+    parser.add_argument('--crews', type=int, default=defaults.crews)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each stage')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    stage_params = SyntheticStageParams(
+        length_km=args.length_km,
+        frequency_hz=None,
+        noise_m=args.noise_m,
+        stops=args.stops,
+        crews=args.crews,
+        seed=args.seed
+    )
+
+    runs = run_benchmarks(stage_params, args.frequencies, args.repeat)
+
+    baseline_runs = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_runs = json.load(f)['runs']
+    print_results(runs, baseline_runs)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'format_version': RESULTS_FORMAT_VERSION,
+            'created': datetime.now().isoformat(),
+            'git_revision': _get_git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'runs': runs
+        }, f, indent=2)
+    print('Results saved to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
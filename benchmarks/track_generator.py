@@ -0,0 +1,248 @@
+"""
+Deterministic generator of synthetic rally stage tracks. All crews drive the same random road from start to finish,
+each with its own pace, GPS noise and stops, and start with an interval after each other as on a real special stage.
+Tracks are written in the formats supported by gpstools.parser
+"""
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+# length_km - stage length, frequency_hz - logging frequency, noise_m - standard deviation of GPS position noise,
+# stops - number of stops on the stage for each crew, crews - number of tracks, seed - random seed
+SyntheticStageParams = namedtuple('SyntheticStageParams',
+                                  ['length_km', 'frequency_hz', 'noise_m', 'stops', 'crews', 'seed'])
+
+DEFAULT_SYNTHETIC_STAGE_PARAMS = SyntheticStageParams(
+    length_km=10,
+    frequency_hz=10,
+    noise_m=1.5,
+    stops=1,
+    crews=4,
+    seed=1
+)
+
+# Track columns, micros are UTC microseconds since epoch, speed in m/s, bearing in degrees
+SyntheticTrack = namedtuple('SyntheticTrack', ['name', 'micros', 'lat', 'lon', 'altitude', 'speed', 'bearing'])
+
+EARTH_RADIUS_M = 6371008.8
+
+STAGE_START_LAT = 56.1
+STAGE_START_LON = 40.4
+STAGE_START_TIME = datetime(2019, 9, 29, 10, 0, tzinfo=timezone.utc)
+
+ROAD_STEP_M = 1.0
+ROAD_CURVATURE_SMOOTHING_M = 200
+ROAD_CURVATURE_SCALE = 0.1
+
+CREW_START_INTERVAL_SECONDS = 120
+IDLE_BEFORE_START_SECONDS = 45
+IDLE_AFTER_FINISH_SECONDS = 45
+STOP_DURATION_SECONDS = 30
+
+CAR_MAX_SPEED_MPS = 45.0
+CAR_MAX_LATERAL_ACCELERATION = 9.0
+CAR_MAX_ACCELERATION = 4.0
+CAR_MAX_BRAKING = 8.0
+
+SPEED_NOISE_MPS = 0.2
+STATIONARY_SPEED_NOISE_MPS = 0.1
+
+MICROS_IN_SECOND = 1000000
+
+
+def generate_stage(params=DEFAULT_SYNTHETIC_STAGE_PARAMS):
+    """@:returns list of SyntheticTrack, one for each crew"""
+    rng = np.random.RandomState(params.seed)
+    road = _generate_road(rng, params.length_km)
+
+    return [_generate_crew_track(rng, road, params, crew) for crew in range(params.crews)]
+
+
+def write_stage(tracks, output_dir, formats=None):
+    """
+    Writes tracks into output_dir, formats are assigned to crews in turn
+    @:param formats - list of TRACK_WRITERS keys, all formats by default
+    @:returns list of written file paths
+    """
+    if formats is None:
+        formats = list(TRACK_WRITERS.keys())
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = []
+    for i, track in enumerate(tracks):
+        extension, writer = TRACK_WRITERS[formats[i % len(formats)]]
+        path = os.path.join(output_dir, '%s.%s' % (track.name, extension))
+        writer(path, track)
+        paths.append(path)
+
+    return paths
+
+
+def _generate_road(rng, length_km):
+    """@:returns dict of road columns sampled every ROAD_STEP_M meters"""
+    count = int(length_km * 1000 / ROAD_STEP_M) + 1
+    dist = np.arange(count) * ROAD_STEP_M
+
+    # Smoothed white noise gives curvature (rad/m) with a mix of long bends and tight corners
+    window = np.ones(int(ROAD_CURVATURE_SMOOTHING_M / ROAD_STEP_M)) / (ROAD_CURVATURE_SMOOTHING_M / ROAD_STEP_M)
+    curvature = np.convolve(rng.normal(0, 1, count), window, mode='same') * ROAD_CURVATURE_SCALE
+    heading = np.cumsum(curvature) * ROAD_STEP_M + rng.uniform(0, 2 * np.pi)
+
+    north = np.concatenate([[0.0], np.cumsum(np.cos(heading[:-1]))]) * ROAD_STEP_M
+    east = np.concatenate([[0.0], np.cumsum(np.sin(heading[:-1]))]) * ROAD_STEP_M
+
+    return {
+        'dist': dist,
+        'curvature': curvature,
+        'lat': STAGE_START_LAT + np.degrees(north / EARTH_RADIUS_M),
+        'lon': STAGE_START_LON + np.degrees(east / (EARTH_RADIUS_M * np.cos(np.radians(STAGE_START_LAT)))),
+        'altitude': 150 + 20 * np.sin(dist / 800) + np.cumsum(rng.normal(0, 0.05, count)),
+        'bearing': np.degrees(heading) % 360,
+    }
+
+
+def _generate_crew_track(rng, road, params, crew):
+    skill = 0.85 + 0.15 * rng.rand()
+    stop_indices = np.sort(rng.randint(len(road['dist']) // 10, len(road['dist']) * 9 // 10, params.stops))
+
+    speed_on_road = _calculate_speed_profile(road['curvature'], stop_indices, skill)
+
+    # Knots of (time, distance), stops add STOP_DURATION_SECONDS at the same distance
+    segment_speed = np.maximum((speed_on_road[1:] + speed_on_road[:-1]) / 2, 0.1)
+    knot_times = np.concatenate([[0.0], np.cumsum(ROAD_STEP_M / segment_speed)]) + IDLE_BEFORE_START_SECONDS
+    knot_dists = road['dist']
+    for stop_idx in stop_indices[::-1].tolist():
+        knot_times = np.insert(knot_times, stop_idx + 1, knot_times[stop_idx])
+        knot_times[stop_idx + 1:] += STOP_DURATION_SECONDS
+        knot_dists = np.insert(knot_dists, stop_idx + 1, knot_dists[stop_idx])
+
+    duration = knot_times[-1] + IDLE_AFTER_FINISH_SECONDS
+    times = np.arange(0, duration, 1.0 / params.frequency_hz)
+    dist = np.interp(times, knot_times, knot_dists)
+
+    # Interpolated road speed is kept for moving points only, so stops and idle points are stationary
+    is_moving = np.concatenate([[False], np.diff(dist) > 0])
+    speed = np.where(
+        is_moving,
+        np.maximum(np.interp(dist, road['dist'], speed_on_road) + rng.normal(0, SPEED_NOISE_MPS, len(times)), 0),
+        np.abs(rng.normal(0, STATIONARY_SPEED_NOISE_MPS, len(times)))
+    )
+
+    noise_north = rng.normal(0, params.noise_m, len(times))
+    noise_east = rng.normal(0, params.noise_m, len(times))
+
+    start_micros = int(STAGE_START_TIME.timestamp()) * MICROS_IN_SECOND + \
+        crew * CREW_START_INTERVAL_SECONDS * MICROS_IN_SECOND
+
+    return SyntheticTrack(
+        name='crew_%d' % (crew + 1),
+        micros=start_micros + np.round(times * MICROS_IN_SECOND).astype(np.int64),
+        lat=np.interp(dist, road['dist'], road['lat']) + np.degrees(noise_north / EARTH_RADIUS_M),
+        lon=np.interp(dist, road['dist'], road['lon']) +
+        np.degrees(noise_east / (EARTH_RADIUS_M * np.cos(np.radians(STAGE_START_LAT)))),
+        altitude=np.interp(dist, road['dist'], road['altitude']) + rng.normal(0, params.noise_m, len(times)),
+        speed=speed,
+        bearing=np.interp(dist, road['dist'], road['bearing'])
+    )
+
+
+def _calculate_speed_profile(curvature, stop_indices, skill):
+    """Speed limited by corners, car acceleration and braking, zero at start, stops and finish"""
+    max_speed = np.minimum(
+        CAR_MAX_SPEED_MPS * skill,
+        np.sqrt(CAR_MAX_LATERAL_ACCELERATION * skill / np.maximum(np.abs(curvature), 1e-6))
+    )
+    max_speed[0] = 0.0
+    max_speed[-1] = 0.0
+    max_speed[stop_indices] = 0.0
+
+    speed = max_speed.tolist()
+    for i in range(1, len(speed)):
+        speed[i] = min(speed[i], (speed[i - 1] ** 2 + 2 * CAR_MAX_ACCELERATION * skill * ROAD_STEP_M) ** 0.5)
+    for i in range(len(speed) - 2, -1, -1):
+        speed[i] = min(speed[i], (speed[i + 1] ** 2 + 2 * CAR_MAX_BRAKING * ROAD_STEP_M) ** 0.5)
+
+    return np.array(speed)
+
+
+def _format_iso_times(micros):
+    """@:returns list of UTC timestamps with milliseconds, e.g. 2019-09-29T10:15:07.100Z"""
+    return [t + 'Z' for t in np.datetime_as_string(micros.astype('datetime64[us]'), unit='ms').tolist()]
+
+
+def _format_degrees_minutes(values, positive_hemisphere, negative_hemisphere):
+    hemispheres = np.where(values >= 0, positive_hemisphere, negative_hemisphere).tolist()
+    values = np.abs(values)
+    degrees = np.floor(values)
+    minutes = (values - degrees) * 60
+    return [
+        '%d°%.5f %s' % (d, m, h) for d, m, h in zip(degrees.tolist(), minutes.tolist(), hemispheres)
+    ]
+
+
+def write_gpx(path, track):
+    """Racebox GPX export, speed in kph"""
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<gpx version="1.0" creator="Racebox" xmlns="http://www.topografix.com/GPX/1/0">\n')
+        f.write('<trk><name>%s</name><trkseg>\n' % track.name)
+        f.writelines(
+            '<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%s</time><speed>%.2f</speed></trkpt>\n' % row
+            for row in zip(track.lat.tolist(), track.lon.tolist(), track.altitude.tolist(),
+                           _format_iso_times(track.micros), (track.speed * 3.6).tolist())
+        )
+        f.write('</trkseg></trk>\n</gpx>\n')
+
+
+def write_racebox_csv(path, track):
+    with open(path, 'w') as f:
+        f.write('Record;Time;Lat;Lon;Alt (m);Speed (kph);Course (deg);GForceX;GForceY\n')
+        f.writelines(
+            '%d;%s;%.7f;%.7f;%.1f;%.2f;%.1f;0.00;0.00\n' % row
+            for row in zip(range(1, len(track.micros) + 1), _format_iso_times(track.micros), track.lat.tolist(),
+                           track.lon.tolist(), track.altitude.tolist(), (track.speed * 3.6).tolist(),
+                           track.bearing.tolist())
+        )
+
+
+def write_racechrono_csv(path, track):
+    """RaceChrono iOS export, timestamps in epoch seconds"""
+    with open(path, 'w') as f:
+        f.write('This file is created using RaceChrono v7.0.0 ( http://www.racechrono.com/ ).\n')
+        f.write('Format,1\nSession title,"%s"\nSession type,Lap timing\n\n' % track.name)
+        f.write('Time (s),Latitude,Longitude,Altitude (m),Speed (m/s),Bearing (deg)\n')
+        f.writelines(
+            '%.3f,%.7f,%.7f,%.1f,%.2f,%.1f\n' % row
+            for row in zip((track.micros / MICROS_IN_SECOND).tolist(), track.lat.tolist(), track.lon.tolist(),
+                           track.altitude.tolist(), track.speed.tolist(), track.bearing.tolist())
+        )
+
+
+def write_racelogic_csv(path, track):
+    """Racelogic export, time of day only and longitude hemisphere inverted as in real logs"""
+    start_time = datetime.fromtimestamp(track.micros[0] / MICROS_IN_SECOND, timezone.utc)
+    times = [t[11:22] for t in np.datetime_as_string(track.micros.astype('datetime64[us]'), unit='ms').tolist()]
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[File]\nDate,%s\nTime,%s\nVersion,1\n\n[Data]\n\n' % (
+            start_time.strftime('%d/%m/%Y'), start_time.strftime('%H:%M')
+        ))
+        f.write('Time,Latitude,Longitude,Height,Velocity,Heading\n')
+        f.writelines(
+            '%s,%s,%s,%.1f,%.2f,%.1f\n' % row
+            for row in zip(times, _format_degrees_minutes(track.lat, 'N', 'S'),
+                           _format_degrees_minutes(-track.lon, 'E', 'W'), track.altitude.tolist(),
+                           (track.speed * 3.6).tolist(), track.bearing.tolist())
+        )
+
+
+# Format name -> (file extension, writer)
+TRACK_WRITERS = {
+    'gpx': ('gpx', write_gpx),
+    'racebox': ('csv', write_racebox_csv),
+    'racechrono': ('csv', write_racechrono_csv),
+    'racelogic': ('csv', write_racelogic_csv),
+}
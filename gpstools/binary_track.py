@@ -0,0 +1,89 @@
+"""
+Native binary track format for very large logs. File consists of a fixed-size header followed by point columns
+(see TrackPointArray.COLUMNS), each column is a contiguous little-endian array of 8-byte values.
+Reader memory-maps columns, so points are paged in from disk only when accessed
+"""
+import os
+import struct
+from datetime import timedelta, timezone
+
+import numpy as np
+
+from gpstools.track.track import TrackPointArray
+
+BINARY_TRACK_EXTENSION = 'gtb'
+
+BINARY_TRACK_MAGIC = b'GPSTRACK'
+BINARY_TRACK_VERSION = 1
+
+# magic, version, flags, timezone offset seconds, points count, padded to keep columns 8-byte aligned
+BINARY_TRACK_HEADER = struct.Struct('<8sHHiQ')
+BINARY_TRACK_HEADER_SIZE = 32
+
+BINARY_TRACK_FLAG_TZ_AWARE = 1
+
+BINARY_TRACK_COLUMN_DTYPES = {
+    'micros': np.dtype('<i8'),
+    'lat': np.dtype('<f8'),
+    'lon': np.dtype('<f8'),
+    'altitude': np.dtype('<f8'),
+    'speed': np.dtype('<f8'),
+    'bearing': np.dtype('<f8'),
+}
+
+
+def write_binary_track(filepath, points):
+    """Writes TrackPointArray, timezone should be a fixed offset (as TrackPointArray always has)"""
+    flags = 0
+    tz_offset_seconds = 0
+    if points.tzinfo is not None:
+        flags |= BINARY_TRACK_FLAG_TZ_AWARE
+        tz_offset_seconds = int(points.tzinfo.utcoffset(None).total_seconds())
+
+    header = BINARY_TRACK_HEADER.pack(
+        BINARY_TRACK_MAGIC, BINARY_TRACK_VERSION, flags, tz_offset_seconds, len(points)
+    )
+
+    with open(filepath, 'wb') as f:
+        f.write(header.ljust(BINARY_TRACK_HEADER_SIZE, b'\0'))
+        for name in TrackPointArray.COLUMNS:
+            np.asarray(getattr(points, name), dtype=BINARY_TRACK_COLUMN_DTYPES[name]).tofile(f)
+
+
+def read_binary_track(filepath):
+    """
+    @:returns TrackPointArray with read-only columns memory-mapped from the file
+    @:raises ValueError for files of other formats or truncated files
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(BINARY_TRACK_HEADER_SIZE)
+    if len(header) < BINARY_TRACK_HEADER_SIZE:
+        raise ValueError("Binary track header is truncated")
+
+    magic, version, flags, tz_offset_seconds, count = BINARY_TRACK_HEADER.unpack_from(header)
+    if magic != BINARY_TRACK_MAGIC:
+        raise ValueError("Not a binary track file")
+    if version != BINARY_TRACK_VERSION:
+        raise ValueError("Unsupported binary track version %d" % version)
+
+    expected_size = BINARY_TRACK_HEADER_SIZE + count * sum(
+        BINARY_TRACK_COLUMN_DTYPES[name].itemsize for name in TrackPointArray.COLUMNS
+    )
+    if os.path.getsize(filepath) < expected_size:
+        raise ValueError("Binary track is truncated, expected %d points" % count)
+
+    columns = {}
+    offset = BINARY_TRACK_HEADER_SIZE
+    for name in TrackPointArray.COLUMNS:
+        dtype = BINARY_TRACK_COLUMN_DTYPES[name]
+        if count > 0:
+            columns[name] = np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        else:
+            columns[name] = np.zeros(0, dtype=dtype)  # Empty files can't be mapped
+        offset += count * dtype.itemsize
+
+    tzinfo = None
+    if flags & BINARY_TRACK_FLAG_TZ_AWARE:
+        tzinfo = timezone(timedelta(seconds=tz_offset_seconds))
+
+    return TrackPointArray(tzinfo=tzinfo, **columns)
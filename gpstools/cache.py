@@ -0,0 +1,165 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+from datetime import timedelta, timezone
+
+import numpy as np
+
+from gpstools.track.normalization import DEFAULT_TRACK_NORMALIZATION_PARAMS
+from gpstools.track.speed_calculation import DEFAULT_SPEED_PARAMS
+from gpstools.track.track import Track, TrackPointArray
+
+# Should be increased on every change of stored arrays or of parsing/normalization logic
+CACHE_FORMAT_VERSION = 2
+CACHE_FILE_EXTENSION = '.npz'
+
+DEFAULT_CACHE_PATH = '.gpstools_cache'
+DEFAULT_CACHE_MAX_SIZE_BYTES = 1024 * 1024 * 1024
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class TrackCache:
+    """
+    On-disk cache of parsed tracks. Entry contains all tracks of a file with normalized points and calculated speed,
+    so loading it skips parsing, points errors fixing, normalization and speed calculation.
+    Entries are keyed by file content hash (or by path, size and mtime when hash_content is False) together
+    with normalization and speed params. Least recently used entries are evicted when total size exceeds max_size_bytes.
+    Binary track files are not cached, they are memory-mapped on load already
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_bytes=DEFAULT_CACHE_MAX_SIZE_BYTES, hash_content=True):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hash_content = hash_content
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_key(self, filepath, norm_params=None, speed_params=None):
+        key = hashlib.sha1()
+        key.update(str(CACHE_FORMAT_VERSION).encode())
+        key.update(repr(tuple(norm_params if norm_params else DEFAULT_TRACK_NORMALIZATION_PARAMS)).encode())
+        key.update(repr(tuple(speed_params if speed_params else DEFAULT_SPEED_PARAMS)).encode())
+
+        if self.hash_content:
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    key.update(chunk)
+        else:
+            stat = os.stat(filepath)
+            key.update(('%s:%d:%d' % (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)).encode())
+
+        return key.hexdigest()
+
+    def get_tracks(self, key, file_name, norm_params=None, speed_params=None):
+        """
+        @:returns list of cached tracks of the file or None, params should be the same as used for the key
+        @:param file_name - stored track names are relative to it, so renamed files with the same content are hits
+        """
+        entry_path = self._get_entry_path(key)
+        tracks = []
+        try:
+            with np.load(entry_path) as entry:
+                for i, name_suffix in enumerate(entry['name_suffixes'].tolist()):
+                    points = TrackPointArray(
+                        micros=entry['micros_%d' % i],
+                        lat=entry['lat_%d' % i],
+                        lon=entry['lon_%d' % i],
+                        altitude=entry['altitude_%d' % i],
+                        speed=entry['point_speed_%d' % i],
+                        bearing=entry['bearing_%d' % i],
+                        tzinfo=_decode_tzinfo(entry['tz_offset_seconds_%d' % i])
+                    )
+                    tracks.append((file_name + name_suffix, points, entry['speed_%d' % i]))
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # Missing, truncated or corrupt entry is a miss, it is rewritten by put_tracks
+            return None
+
+        # Updating access time for eviction
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass  # Evicted by another process
+
+        print('Load %d tracks of %s from cache' % (len(tracks), file_name))
+        return [
+            Track.from_normalized_points(name, points, speed_params, norm_params, speed=speed)
+            for name, points, speed in tracks
+        ]
+
+    def put_tracks(self, key, file_name, tracks):
+        entry_path = self._get_entry_path(key)
+
+        arrays = {'name_suffixes': np.array([track.name[len(file_name):] for track in tracks], dtype=str)}
+        for i, track in enumerate(tracks):
+            arrays['micros_%d' % i] = track.points.micros
+            arrays['lat_%d' % i] = track.points.lat
+            arrays['lon_%d' % i] = track.points.lon
+            arrays['altitude_%d' % i] = track.points.altitude
+            arrays['point_speed_%d' % i] = track.points.speed
+            arrays['bearing_%d' % i] = track.points.bearing
+            arrays['tz_offset_seconds_%d' % i] = _encode_tzinfo(track.points.tzinfo)
+            arrays['speed_%d' % i] = track.speed
+
+        # Writing to temporary file first, so concurrent loaders never see partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.savez(tmp_file, **arrays)
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            _remove_silently(tmp_path)
+            raise
+
+        self._evict()
+
+    def clear(self):
+        for entry_path, _, _ in self._list_entries():
+            _remove_silently(entry_path)
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, key + CACHE_FILE_EXTENSION)
+
+    def _list_entries(self):
+        """@:returns list of (path, size, access time) for each entry"""
+        entries = []
+        for f in os.listdir(self.path):
+            if f.endswith(CACHE_FILE_EXTENSION):
+                entry_path = os.path.join(self.path, f)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue  # Removed by another process
+                entries.append((entry_path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._list_entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+        for entry_path, size, _ in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            _remove_silently(entry_path)
+            total_size -= size
+
+
+def _encode_tzinfo(tzinfo):
+    """Track timezone is always a fixed offset, empty array stands for naive timestamps"""
+    if tzinfo is None:
+        return np.zeros(0, dtype=np.int64)
+    return np.array([int(tzinfo.utcoffset(None).total_seconds())], dtype=np.int64)
+
+
+def _decode_tzinfo(tz_offset_seconds):
+    if len(tz_offset_seconds) == 0:
+        return None
+    return timezone(timedelta(seconds=int(tz_offset_seconds[0])))
+
+
+def _remove_silently(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
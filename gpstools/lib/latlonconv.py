@@ -10,6 +10,9 @@ Licensed under the GPLv3: http://www.gnu.org/licenses/gpl-3.0.html
 """
 import re
 import abc
+from functools import lru_cache
+
+import numpy as np
 
 '''
 Methods for representing geographic coordinates (latitude and longitude)
@@ -264,6 +267,108 @@ def string2geocoord(coord_str, coord_class, format_str = 'D'):
     new_coord._update() # Change all of the variables in the coordinate class so they are consistent with each other
     return new_coord
 
+GEOCOORD_FORMAT_FIELDS = ['H', 'M', 'm', 'd', 'D', 'S']
+GEOCOORD_HEMISPHERES = {Latitude: ('N', 'S'), Longitude: ('E', 'W')}
+
+def strings2decimal_degrees(coord_strs, coord_class, format_str = 'D'):
+    '''
+    Bulk version of string2geocoord for a whole column of coordinates.
+    Inputs:
+        coord_strs (list of str) - string representations of geographic coordinates
+        coord_class (class) - Latitude or Longitude
+        format_str (str) - format of the strings, see string2geocoord
+    Returns:
+        numpy array with decimal degrees, equal to string2geocoord(coord_str, coord_class, format_str).decimal_degree
+        for each string. ValueError is raised for the first invalid string
+    '''
+    return _compile_geocoord_decoder(coord_class, format_str)(coord_strs)
+
+@lru_cache(maxsize=None)
+def _compile_geocoord_decoder(coord_class, format_str):
+    '''
+    Builds decoder for given format: single regex splitting strings the same way as string2geocoord does
+    (by the first occurrence of each separator) and numpy version of GeoCoord arithmetic
+    '''
+    if format_str[0] == 'H':
+        # Hemisphere in front requires strings rewriting, it's rare enough to go through string2geocoord
+        return lambda coord_strs: np.array([string2geocoord(coord_str, coord_class, format_str).decimal_degree
+                                            for coord_str in coord_strs], dtype=np.float64)
+
+    format_elements = format_str.split('%')
+    separators = [sep for sep in format_elements if sep not in GEOCOORD_FORMAT_FIELDS]
+    separators.append('%')
+    formatters = [form for form in format_elements if form in GEOCOORD_FORMAT_FIELDS]
+    pattern = re.compile('^' + ''.join('(.*?)(?:%s|$)' % re.escape(sep) for form, sep in zip(formatters, separators)),
+                         re.MULTILINE)
+    hemispheres = GEOCOORD_HEMISPHERES[coord_class]
+
+    def decode(coord_strs):
+        if len(coord_strs) == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        matches = pattern.findall('\n'.join(coord_strs))
+        if len(matches) != len(coord_strs) or len(formatters) == 0:
+            # Line breaks inside of strings
+            return np.array([string2geocoord(coord_str, coord_class, format_str).decimal_degree
+                             for coord_str in coord_strs], dtype=np.float64)
+        columns = [np.array(column) for column in zip(*matches)] if len(formatters) > 1 else [np.array(matches)]
+
+        degree = np.zeros(len(coord_strs))
+        minute = np.zeros(len(coord_strs))
+        second = np.zeros(len(coord_strs))
+        for form, column in zip(formatters, columns):
+            if form == 'H':
+                is_positive = column == hemispheres[0]
+                is_negative = column == hemispheres[1]
+                if not np.all(is_positive | is_negative):
+                    _raise_first_invalid(coord_strs, coord_class, format_str)
+                signs = np.where(is_negative, -1.0, 1.0)
+                degree, minute, second = np.abs(degree) * signs, np.abs(minute) * signs, np.abs(second) * signs
+                _, degree, minute, second = _update_arrays(degree, minute, second)
+            else:
+                try:
+                    values = column.astype(np.float64)
+                except ValueError:
+                    _raise_first_invalid(coord_strs, coord_class, format_str)
+                if form in ('d', 'D'):
+                    degree = values
+                elif form in ('M', 'm'):
+                    minute = values
+                else:
+                    second = values
+
+        decimal_degree, _, _, _ = _update_arrays(degree, minute, second)
+        return decimal_degree
+
+    return decode
+
+def _calc_decimaldegree_arrays(degree, minute, second):
+    '''
+    Numpy version of GeoCoord._calc_decimaldegree
+    '''
+    return degree + minute/60. + second/3600.
+
+def _update_arrays(degree, minute, second):
+    '''
+    Numpy version of GeoCoord._update, returns decimal degree and cleaned up degree, minute and second
+    '''
+    decimal_degree = _calc_decimaldegree_arrays(degree, minute, second)
+    sign = np.sign(decimal_degree)
+    abs_decimal_degree = np.abs(decimal_degree)
+    degree = np.floor_divide(abs_decimal_degree, 1)
+    decimal_minute = (abs_decimal_degree - degree)*60.
+    minute = np.floor_divide(decimal_minute, 1)
+    second = (decimal_minute - minute)*60.
+    return decimal_degree, degree*sign, minute*sign, second*sign
+
+def _raise_first_invalid(coord_strs, coord_class, format_str):
+    for i, coord_str in enumerate(coord_strs):
+        try:
+            string2geocoord(coord_str, coord_class, format_str)
+        except ValueError:
+            raise ValueError('Invalid coordinate in row %d: %s' % (i + 1, coord_str))
+    raise ValueError('Invalid coordinates')
+
 class LatLon:
     '''
     Object representing lat/lon pairs
@@ -1,19 +1,28 @@
 import csv
 import os
-from copy import deepcopy
-import datetime
-from datetime import datetime
-import dateutil
-import gpxpy
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 from collections import namedtuple
+from lxml import etree
 
-from gpstools.track.track import Track, TrackPoint
+from gpstools.binary_track import BINARY_TRACK_EXTENSION, read_binary_track, write_binary_track
+from gpstools.timestamps import decode_timestamps, decode_epoch_seconds, repair_timestamps, \
+    TIMESTAMP_FIX_MILLIS_SCALE, TIMESTAMP_FIX_SUBSECOND_PRECISION
+from gpstools.track.track import Track, TrackPointArray
 
-from gpstools.lib.latlonconv import string2geocoord, Latitude, Longitude
+from gpstools.lib.latlonconv import strings2decimal_degrees, Latitude, Longitude
 
 CSV_EXTENSION = 'csv'
 GPX_EXTENSION = 'gpx'
-SUPPORTED_EXTENSIONS = [CSV_EXTENSION, GPX_EXTENSION]
+SUPPORTED_EXTENSIONS = [CSV_EXTENSION, GPX_EXTENSION, BINARY_TRACK_EXTENSION]
+
+# Default subdirectory for converted binary tracks, they are kept apart from source files, so loading the source
+# directory doesn't load each track twice
+BINARY_TRACKS_DIR = 'binary'
+
+# Top-level GPX elements which are not used, dropped after parsing to keep memory constant
+GPX_SKIPPED_ELEMENTS = {'wpt', 'rte', 'trk'}
 
 
 class TrackParsingError(Exception):
@@ -26,27 +35,58 @@ class TrackParsingError(Exception):
 TrackFile = namedtuple('TrackFile', ['path', 'name', 'ext'])
 
 
-def load_track(filepath, norm_params=None):
+def load_track(filepath, norm_params=None, cache=None):
+    """
+    Loads the first track of the file, use load_tracks for files with multiple tracks or segments
+    @:param cache - optional TrackCache with previously parsed tracks
+    """
+    tracks = load_tracks(filepath, norm_params, cache)
+    if not tracks:
+        return None
+    if len(tracks) > 1:
+        print("File %s contains %d tracks, using the first one" % (filepath, len(tracks)))
+    return tracks[0]
+
+
+def load_tracks(filepath, norm_params=None, cache=None):
+    """
+    @:param cache - optional TrackCache with previously parsed tracks
+    @:returns list of tracks, one for each track and segment of the file
+    """
     track_file = _check_file_extension(filepath)
     if track_file:
-        return _load_track_file(track_file, norm_params)
+        return _load_track_file(track_file, norm_params, cache)
     else:
         raise TrackParsingError("File %s is not supported!" % filepath)
 
 
-def load_tracks_in_path(path, norm_params=None):
-    """ @:returns list of parsed tracks """
+def load_tracks_in_path(path, norm_params=None, workers=1, cache=None):
+    """
+    @:param workers - number of processes parsing files in parallel, 1 parses files in current process,
+    None uses all available cores
+    @:param cache - optional TrackCache with previously parsed tracks
+    @:returns list of parsed tracks ordered by file name
+    """
     track_files = []
-    for f in os.listdir(path):
+    for f in sorted(os.listdir(path)):
         track_file = _check_file_extension(os.path.join(path, f))
         if track_file:
             track_files.append(track_file)
 
     tracks = []
-    for file in track_files:
-        track_opt = _load_track_file(file, norm_params)
-        if track_opt:
-            tracks.append(track_opt)
+    if workers == 1 or len(track_files) <= 1:
+        for file in track_files:
+            tracks_opt = _load_track_file(file, norm_params, cache)
+            if tracks_opt:
+                tracks.extend(tracks_opt)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_load_track_file_in_worker, track_files, repeat(norm_params), repeat(cache))
+            for file, (tracks_opt, error_message) in zip(track_files, results):
+                if tracks_opt:
+                    tracks.extend(tracks_opt)
+                else:
+                    _report_skipped_track(file, error_message)
 
     print("Load %d tracks:" % len(tracks))
     for track in tracks:
@@ -55,6 +95,31 @@ def load_tracks_in_path(path, norm_params=None):
     return tracks
 
 
+def convert_to_binary_tracks(filepath, output_dir=None):
+    """
+    Converts supported track file into binary track files, one for each track and segment of the file
+    @:param output_dir - directory for converted files, BINARY_TRACKS_DIR subdirectory of the source file directory
+    by default
+    @:returns list of written file paths
+    """
+    track_file = _check_file_extension(filepath)
+    if not track_file or track_file.ext == BINARY_TRACK_EXTENSION:
+        raise TrackParsingError("File %s is not supported!" % filepath)
+
+    if output_dir is None:
+        output_dir = os.path.join(os.path.dirname(filepath), BINARY_TRACKS_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+
+    output_paths = []
+    for name, points in _parse_track_points(track_file):
+        output_path = os.path.join(output_dir, '%s.%s' % (name, BINARY_TRACK_EXTENSION))
+        write_binary_track(output_path, points)
+        print('Converted track %s with %d points to %s' % (name, len(points), output_path))
+        output_paths.append(output_path)
+
+    return output_paths
+
+
 def _check_file_extension(filepath):
     if os.path.isfile(filepath):
         path_segments = filepath.split('/')[-1].split('.')
@@ -66,82 +131,181 @@ def _check_file_extension(filepath):
     return None
 
 
-def _load_track_file(file, norm_params):
-    print('Processing file %s' % file.path)
+def _load_track_file(file, norm_params, cache=None):
     try:
-        if file.ext == GPX_EXTENSION:
-            points = _load_gpx_points(file.path)
-        elif file.ext == CSV_EXTENSION:
-            points = []
-
-            try:
-                points = _load_racebox_csv_points(file.path)
-                print("Detected racebox track")
-            except TrackParsingError as err:
-                print("Looks like not a racebox track, error was %s" % err.message)
-
-            if len(points) == 0:
-                try:
-                    points = _load_racechrono_csv_points(file.path)
-                    print("Detected racechrono track")
-                except TrackParsingError as err:
-                    print("Looks like not a racechrono track, error was %s" % err.message)
-
-            if len(points) == 0:
-                try:
-                    points = _load_racelogic_csv_points(file.path)
-                    print("Detected racelogic track")
-                except TrackParsingError as err:
-                    print("Looks like not a racelogic track, error was %s" % err.message)
-
-            if len(points) == 0:
-                raise TrackParsingError("File %s is not supported!" % file.path)
-        else:
-            raise TrackParsingError("File %s is not supported!" % file.path)
-
+        return _load_cached_track_file(file, norm_params, cache)
     except TrackParsingError as err:
-        print("Skipping track %s due to: %s" % (file.path, err.message))
+        _report_skipped_track(file, err.message)
         return None
 
-    fixed_points = _fix_points_errors(points)
 
-    print('Load track %s with %d points' % (file.name, len(fixed_points)))
-    return Track(file.name, fixed_points, speed_params=None, norm_params=norm_params)
+def _load_track_file_in_worker(file, norm_params, cache):
+    """Parsing errors are returned to the main process to be reported there"""
+    try:
+        tracks = _load_cached_track_file(file, norm_params, cache)
+    except TrackParsingError as err:
+        return None, err.message
+
+    # Track metrics are lazy, speed is calculated here so it isn't left to the main process
+    for track in tracks:
+        track.speed
+    return tracks, None
+
 
+def _report_skipped_track(file, error_message):
+    print("Skipping track %s due to: %s" % (file.path, error_message))
 
-def _load_gpx_points(filename):
-    gpx_file = open(filename, 'r')
-    gpx = gpxpy.parse(gpx_file)
 
-    if len(gpx.tracks) != 1:
-        raise TrackParsingError("GPX track with multiple tracks!")
-    if len(gpx.tracks[0].segments) != 1:
-        raise TrackParsingError("GPX track with multiple segments!")
+def _load_cached_track_file(file, norm_params, cache):
+    # Binary tracks are memory-mapped, copying them into cache entries would only double disk use
+    if cache is None or file.ext == BINARY_TRACK_EXTENSION:
+        return _parse_track_file(file, norm_params)
 
-    speed_in_mps = True
-    print('Parsing %s gpx track' % gpx.creator)
-    if gpx.creator == 'Racebox':
-        speed_in_mps = False
+    key = cache.get_key(file.path, norm_params)
+    tracks = cache.get_tracks(key, file.name, norm_params)
+    if tracks is None:
+        tracks = _parse_track_file(file, norm_params)
+        cache.put_tracks(key, file.name, tracks)
 
-    gpx_track = gpx.tracks[0].segments[0].points
+    return tracks
 
-    points = []
-    for point in gpx_track:
-        if point.speed is None:
-            speed = 0.0
+
+def _parse_track_file(file, norm_params):
+    """@:returns list of tracks, files with multiple tracks or segments get track and segment numbers in names"""
+    tracks = []
+    for name, points in _parse_track_points(file):
+        print('Load track %s with %d points' % (name, len(points)))
+        tracks.append(Track(name, points, speed_params=None, norm_params=norm_params))
+
+    return tracks
+
+
+def _parse_track_points(file):
+    """@:returns list of (track name, TrackPointArray) with fixed points errors"""
+    print('Processing file %s' % file.path)
+    if file.ext == BINARY_TRACK_EXTENSION:
+        try:
+            points = read_binary_track(file.path)
+        except ValueError as err:
+            raise TrackParsingError(str(err))
+
+        if len(points) == 0:
+            raise TrackParsingError("File %s has no points!" % file.path)
+
+        # Points were fixed on conversion, so mapped columns are used as is
+        return [(file.name, points)]
+
+    if file.ext == GPX_EXTENSION:
+        segments = _load_gpx_segments(file.path)
+        if len(segments) == 1:
+            named_points = [(file.name, segments[0][2])]
         else:
-            speed = point.speed if speed_in_mps else float(point.speed) / 3.6
+            named_points = [
+                ('%s_trk%d_seg%d' % (file.name, track_idx + 1, segment_idx + 1), points)
+                for track_idx, segment_idx, points in segments
+            ]
+    elif file.ext == CSV_EXTENSION:
+        with open(file.path, newline='') as csv_file:
+            csv_format = _detect_csv_format(csv_file)
+            if csv_format is None:
+                raise TrackParsingError("File %s is not supported!" % file.path)
 
-        points.append(TrackPoint(
-            time=point.time,
-            lat=point.latitude,
-            lon=point.longitude,
-            altitude=point.elevation,
-            speed=speed,
-            bearing=None
-        ))
+            print("Detected %s track" % csv_format.name)
+            named_points = [(file.name, csv_format.load_points(csv_file))]
+    else:
+        raise TrackParsingError("File %s is not supported!" % file.path)
 
-    return points
+    if len(named_points) == 0 or len(named_points[0][1]) == 0:
+        raise TrackParsingError("File %s has no points!" % file.path)
+
+    return [(name, _fix_points_errors(points)) for name, points in named_points]
+
+
+def _load_gpx_segments(filename):
+    """
+    Streams <trkpt> elements one by one, processed elements are removed from the tree, so memory doesn't depend on
+    the file size
+    @:returns list of (track index, segment index, TrackPointArray) for each non-empty segment
+    """
+    segments = []
+    speed_in_mps = True
+    track_idx = -1
+    segment_idx = -1
+    times = []
+    values = []
+
+    try:
+        for event, elem in etree.iterparse(filename, events=('start', 'end')):
+            tag = _get_local_name(elem.tag)
+            if event == 'start':
+                if tag == 'gpx':
+                    creator = elem.get('creator')
+                    print('Parsing %s gpx track' % creator)
+                    speed_in_mps = creator != 'Racebox'
+                elif tag == 'trk':
+                    track_idx += 1
+                    segment_idx = -1
+                elif tag == 'trkseg':
+                    segment_idx += 1
+                    times = []
+                    values = []
+            elif tag == 'trkpt':
+                times.append(_read_gpx_point(elem, speed_in_mps, values))
+
+                # Dropping processed points, so the tree doesn't grow
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif tag == 'trkseg':
+                if len(times) > 0:
+                    micros, tzinfo = _decode_timestamps_column(times)
+                    segments.append((track_idx, segment_idx, _build_point_array(micros, tzinfo, values)))
+                elem.clear()
+            elif tag in GPX_SKIPPED_ELEMENTS:
+                elem.clear()
+    except etree.XMLSyntaxError as err:
+        raise TrackParsingError("Invalid GPX: %s" % err)
+
+    return segments
+
+
+def _read_gpx_point(elem, speed_in_mps, values):
+    """Appends point values to the list, @:returns point timestamp string"""
+    time = None
+    altitude = None
+    speed = 0.0
+    try:
+        lat = float(elem.get('lat'))
+        lon = float(elem.get('lon'))
+        for child in elem:
+            child_tag = _get_local_name(child.tag)
+            if child_tag == 'time':
+                time = child.text.strip()
+            elif child_tag == 'ele':
+                altitude = float(child.text)
+            elif child_tag == 'speed':
+                speed = float(child.text) if speed_in_mps else float(child.text) / 3.6
+    except (TypeError, ValueError, AttributeError):
+        raise TrackParsingError("Invalid track point at line %d" % elem.sourceline)
+
+    if time is None:
+        raise TrackParsingError("Track point without time at line %d" % elem.sourceline)
+
+    values.append((lat, lon, altitude, speed, None))
+    return time
+
+
+def _get_local_name(tag):
+    """Strips namespace, GPX 1.0 and 1.1 differ only by it for the used elements"""
+    if not isinstance(tag, str):
+        return None  # Comments and processing instructions
+    return tag.rpartition('}')[2]
+
+
+def _build_point_array(micros, tzinfo, values):
+    """Builds TrackPointArray from decoded timestamps and list of (lat, lon, altitude, speed, bearing) tuples"""
+    lat, lon, altitude, speed, bearing = np.array(values, dtype=np.float64).reshape(-1, 5).T
+    return TrackPointArray(micros, lat, lon, altitude, speed, bearing, tzinfo=tzinfo)
 
 
 RACECHRONO_TIME_FIELD = 'Time (s)'
@@ -160,9 +324,7 @@ RACECHRONO_MAX_HEADER_LINES = 20
 RACECHRONO_INVALID_ROWS_THRESHOLD = 50
 
 
-def _load_racechrono_csv_points(filename):
-    csv_file = open(filename, newline='')
-
+def _load_racechrono_csv_points(csv_file):
     # Seeking position for track start
     # Racechrono has several lines of headers, then empty line and the rest of the lines are actual track
     # Seeking for it
@@ -182,31 +344,31 @@ def _load_racechrono_csv_points(filename):
     track = csv.DictReader(csv_file, delimiter=',')
 
     invalid_rows = 0
-    points = []
+    times = []
+    values = []
     for row in track:
         try:
             time_seconds_float = float(row[RACECHRONO_TIME_FIELD])
-            time_seconds = int(time_seconds_float)
-            time_microseconds = int(time_seconds_float % 1 * 1000000)
-            time = datetime.fromtimestamp(time_seconds).replace(microsecond=time_microseconds)
-            points.append(TrackPoint(
-                time=time,
-                lat=float(row[RACECHRONO_LAT_FIELD_IOS]),
-                lon=float(row[RACECHRONO_LON_FIELD_IOS]),
-                altitude=float(row[RACECHRONO_ALT_FIELD]),
-                speed=float(row[RACECHRONO_SPEED_FIELD]),
-                bearing=float(row[RACECHRONO_BEARING_FIELD]),
+            values.append((
+                float(row[RACECHRONO_LAT_FIELD_IOS]),
+                float(row[RACECHRONO_LON_FIELD_IOS]),
+                float(row[RACECHRONO_ALT_FIELD]),
+                float(row[RACECHRONO_SPEED_FIELD]),
+                float(row[RACECHRONO_BEARING_FIELD]),
             ))
+            times.append(time_seconds_float)
 
         except KeyError:
-            raise TrackParsingError("Found invalid row %d: %s" % (len(points) + 1, str(row)))
+            raise TrackParsingError("Found invalid row %d: %s" % (len(values) + 1, str(row)))
         except ValueError:
             invalid_rows += 1
 
     if invalid_rows > RACECHRONO_INVALID_ROWS_THRESHOLD:
         raise TrackParsingError("Too many invalid rows in racechrono track: %d" % invalid_rows)
 
-    print('Load racechrono track %s with %d points' % (filename, len(points)))
+    points = _build_point_array(decode_epoch_seconds(times), None, values)
+
+    print('Load racechrono track %s with %d points' % (csv_file.name, len(points)))
 
     return points
 
@@ -220,27 +382,28 @@ RACEBOX_BEARING_FIELD = 'Course (deg)'
 RACEBOX_TIME_FORMAT = ''
 
 
-def _load_racebox_csv_points(filename):
-    csv_file = open(filename, newline='')
-
+def _load_racebox_csv_points(csv_file):
     track = csv.DictReader(csv_file, delimiter=';')
-    points = []
+    times = []
+    values = []
 
     for row in track:
         try:
-            points.append(TrackPoint(
-                time=dateutil.parser.parse(row[RACEBOX_TIME_FIELD]),
-                lat=float(row[RACEBOX_LAT_FIELD]),
-                lon=float(row[RACEBOX_LON_FIELD]),
-                altitude=float(row[RACEBOX_ALT_FIELD]),
-                speed=float(row[RACEBOX_SPEED_FIELD]) / 3.6,  # Converting from kph to m/s
-                bearing=float(row[RACEBOX_BEARING_FIELD])
+            values.append((
+                float(row[RACEBOX_LAT_FIELD]),
+                float(row[RACEBOX_LON_FIELD]),
+                float(row[RACEBOX_ALT_FIELD]),
+                float(row[RACEBOX_SPEED_FIELD]) / 3.6,  # Converting from kph to m/s
+                float(row[RACEBOX_BEARING_FIELD])
             ))
+            times.append(row[RACEBOX_TIME_FIELD])
 
         except (KeyError, ValueError):
-            raise TrackParsingError("Found invalid row %d: %s" % (len(points) + 1, str(row)))
+            raise TrackParsingError("Found invalid row %d: %s" % (len(values) + 1, str(row)))
+
+    points = _build_point_array(*_decode_timestamps_column(times), values)
 
-    print('Load racebox track %s with %d points' % (filename, len(points)))
+    print('Load racebox track %s with %d points' % (csv_file.name, len(points)))
 
     return points
 
@@ -252,13 +415,12 @@ RACELOGIC_ALT_FIELD = 'Height'
 RACELOGIC_SPEED_FIELD = 'Velocity'
 RACELOGIC_BEARING_FIELD = 'Heading'
 RACELOGIC_TIME_FORMAT = ''
+RACELOGIC_COORD_FORMAT = "d%°%M% %H"
 
 RACELOGIC_MAX_HEADER_LINES = 7
 
 
-def _load_racelogic_csv_points(filename):
-    csv_file = open(filename, newline='')
-
+def _load_racelogic_csv_points(csv_file):
     # Seeking position for track start
     # Racelogic has 7 lines of headers, then empty line and the rest of the lines are actual track
     # Seeking for it
@@ -271,123 +433,126 @@ def _load_racelogic_csv_points(filename):
         lines_skipped += 1
 
     track = csv.DictReader(csv_file, delimiter=',')
-    points = []
+    times = []
+    lat_strs = []
+    lon_strs = []
+    values = []
 
     for row in track:
         try:
-            lat = string2geocoord(row[RACELOGIC_LAT_FIELD], Latitude, "d%°%M% %H").decimal_degree
-            # For some reason we have invalid hemisphere in logs
-            lon = -string2geocoord(row[RACELOGIC_LON_FIELD], Longitude, "d%°%M% %H").decimal_degree
-
-            points.append(TrackPoint(
-                time=dateutil.parser.parse(row[RACELOGIC_TIME_FIELD]),
-                lat=lat,
-                lon=lon,
-                altitude=float(row[RACELOGIC_ALT_FIELD]),
-                speed=float(row[RACELOGIC_SPEED_FIELD]) / 3.6,  # Converting from kph to m/s
-                bearing=float(row[RACELOGIC_BEARING_FIELD])
+            values.append((
+                float(row[RACELOGIC_ALT_FIELD]),
+                float(row[RACELOGIC_SPEED_FIELD]) / 3.6,  # Converting from kph to m/s
+                float(row[RACELOGIC_BEARING_FIELD])
             ))
+            times.append(row[RACELOGIC_TIME_FIELD])
+            lat_strs.append(row[RACELOGIC_LAT_FIELD])
+            lon_strs.append(row[RACELOGIC_LON_FIELD])
 
         except (KeyError, ValueError):
-            raise TrackParsingError("Found invalid row %d: %s" % (len(points) + 1, str(row)))
+            raise TrackParsingError("Found invalid row %d: %s" % (len(values) + 1, str(row)))
+
+    try:
+        lat = strings2decimal_degrees(lat_strs, Latitude, RACELOGIC_COORD_FORMAT)
+        # For some reason we have invalid hemisphere in logs
+        lon = -strings2decimal_degrees(lon_strs, Longitude, RACELOGIC_COORD_FORMAT)
+    except ValueError as err:
+        raise TrackParsingError(str(err))
+
+    micros, tzinfo = _decode_timestamps_column(times)
+    altitude, speed, bearing = np.array(values, dtype=np.float64).reshape(-1, 3).T
+    points = TrackPointArray(micros, lat, lon, altitude, speed, bearing, tzinfo=tzinfo)
 
-    print('Load racelogic track %s with %d points' % (filename, len(points)))
+    print('Load racelogic track %s with %d points' % (csv_file.name, len(points)))
 
     return points
 
 
-def _fix_points_errors(points):
-    """Some tracks has wrong format - bundling checks together"""
-    return _restore_subsecond_precision(_check_incorrect_subsecond_precision(points))
-
-
-# Harry's Lap Timer writes milliseconds with a leading zero, that breaks speed calculations. Checking it
-def _check_incorrect_subsecond_precision(points):
-    has_millis_precision = False
-    has_full_fractions = False
-    for i in range(len(points)):
-        if points[i].time.microsecond > 0:
-            has_millis_precision = True
-        if points[i].time.microsecond >= 100000:
-            has_full_fractions = True
-
-    if has_millis_precision and not has_full_fractions:
-        print("Looks that track has incorrect milliseconds presicion format (i.e written by Harry's Lap Timer). Fixing")
-        fixed_points = []
-        for i in range(len(points)):
-            fixed_point = deepcopy(points[i])
-            fixed_point.time = fixed_point.time.replace(
-                microsecond=fixed_point.time.microsecond * 10
-            )
-            fixed_points.append(fixed_point)
-        return fixed_points
-    else:
-        return points
-
-
-# Some tracks are missing milliseconds precision (like those recorded with XGPS-160 built-in logger)
-def _restore_subsecond_precision(points):
-    are_points_restored = False
-    restored_points = []
-    same_second_points = []
-    current_second = points[0].time.second
-    first_group = True
-    for i in range(len(points)):
-        point = points[i]
-        if point.time.second != current_second:
-            millis_fixed, fixed_points = _restore_points_within_second(same_second_points, first_group)
-            restored_points.extend(fixed_points)
-            first_group = False
-            are_points_restored = are_points_restored | millis_fixed
-            same_second_points = [point]
-            current_second = point.time.second
-        else:
-            same_second_points.append(point)
+def _decode_timestamps_column(times):
+    try:
+        return decode_timestamps(times)
+    except ValueError as err:
+        raise TrackParsingError(str(err))
 
-    millis_fixed, fixed_points = _restore_points_within_second(same_second_points, first_group)
-    restored_points.extend(fixed_points)
-    are_points_restored = are_points_restored | millis_fixed
 
-    if are_points_restored:
-        print("Looks that track has missed subsecond precision. Fixing")
+# Size of the file head used for csv format detection
+CSV_SNIFF_SIZE = 4096
+CSV_DELIMITERS = [',', ';', '\t']
 
-    return restored_points
+# lines - complete lines from the head of the file, delimiter - most frequent delimiter of the first line
+CsvSample = namedtuple('CsvSample', ['lines', 'delimiter'])
 
+# matches - function checking CsvSample, load_points - function loading points from opened csv file
+CsvFormat = namedtuple('CsvFormat', ['name', 'matches', 'load_points'])
 
-def _restore_points_within_second(same_second_points, first_group):
-    if len(same_second_points) > 1 and not _has_millis_precision(same_second_points):
-        return True, _assign_micros_for_points(same_second_points, first_group)
-    else:
-        return False, same_second_points
-
-
-def _has_millis_precision(points):
-    has_millis_precision = False
-    for i in range(len(points)):
-        if points[i].time.microsecond > 0:
-            has_millis_precision = True
-
-    return has_millis_precision
-
-
-def _assign_micros_for_points(points, first_group=None):
-    """When group is first, it means that we have to count points as a last millis in second"""
-    assert len(points) <= 10
-    micros_idx = 0
-    if first_group:
-        micros_idx = 10 - len(points)
-
-    restored_points = []
-    for i in range(len(points)):
-        point = points[i]
-        restored_points.append(TrackPoint(
-            time=point.time.replace(microsecond=micros_idx * 100000),
-            lat=point.latitude,
-            lon=point.longitude,
-            altitude=point.altitude,
-            speed=point.speed,
-            bearing=point.bearing
-        ))
-        micros_idx += 1
-
-    return restored_points
+CSV_FORMATS = []
+
+
+def register_csv_format(name, matches, load_points):
+    """Registers csv track format, formats are checked in registration order"""
+    CSV_FORMATS.append(CsvFormat(name, matches, load_points))
+
+
+def _read_csv_sample(csv_file):
+    """Reads the head of the file and rewinds it, so the file is parsed from the start by format loader"""
+    head = csv_file.read(CSV_SNIFF_SIZE)
+    csv_file.seek(0)
+
+    lines = head.splitlines()
+    if len(head) == CSV_SNIFF_SIZE and len(lines) > 1:
+        lines = lines[:-1]  # Last line can be cut in the middle
+    if len(lines) == 0:
+        return None
+
+    delimiter = max(CSV_DELIMITERS, key=lambda d: lines[0].count(d))
+    return CsvSample(lines, delimiter)
+
+
+def _detect_csv_format(csv_file):
+    sample = _read_csv_sample(csv_file)
+    if sample is None:
+        return None
+
+    for csv_format in CSV_FORMATS:
+        if csv_format.matches(sample):
+            return csv_format
+
+    return None
+
+
+def _is_racebox_csv(sample):
+    columns = sample.lines[0].split(';')
+    return sample.delimiter == ';' and RACEBOX_TIME_FIELD in columns and RACEBOX_LAT_FIELD in columns
+
+
+def _is_racechrono_csv(sample):
+    return 'RaceChrono' in sample.lines[0]
+
+
+def _is_racelogic_csv(sample):
+    return '[File]' in sample.lines[0]
+
+
+register_csv_format('racebox', _is_racebox_csv, _load_racebox_csv_points)
+register_csv_format('racechrono', _is_racechrono_csv, _load_racechrono_csv_points)
+register_csv_format('racelogic', _is_racelogic_csv, _load_racelogic_csv_points)
+
+
+TIMESTAMP_FIX_MESSAGES = {
+    TIMESTAMP_FIX_MILLIS_SCALE:
+        "Looks that track has incorrect milliseconds presicion format (i.e written by Harry's Lap Timer). Fixing",
+    TIMESTAMP_FIX_SUBSECOND_PRECISION: "Looks that track has missed subsecond precision. Fixing",
+}
+
+
+def _fix_points_errors(points):
+    """Some tracks has wrong format - timestamps are fixed in place, @:returns points"""
+    try:
+        fixes = repair_timestamps(points.micros)
+    except ValueError as err:
+        raise TrackParsingError(str(err))
+
+    for fix in fixes:
+        print(TIMESTAMP_FIX_MESSAGES[fix])
+
+    return points
@@ -0,0 +1,227 @@
+from collections import namedtuple
+
+import numpy as np
+
+from gpstools.config import POINT_MAX_DISTANCE_THRESHOLD_KM
+from gpstools.utils import EARTH_RADIUS
+
+# Track points are matched in chunks, each chunk is compared with reference segments in a window of reference
+# distance: from the last matched distance minus a step back (spins) to the distance expected after the chunk
+ALIGNMENT_CHUNK_SIZE = 128
+ALIGNMENT_WINDOW_BACK_KM = 0.05
+ALIGNMENT_WINDOW_AHEAD_MARGIN_KM = 0.2
+
+# Km of offset from the reference equal to 1 km of difference from expected distance. Prefers segments matching
+# travelled distance where reference passes the same place twice, nearest segment wins otherwise
+ALIGNMENT_PROGRESS_WEIGHT = 0.1
+
+# Aligned distance is kept at its running maximum, only steps back longer than this are spins or reversals and not
+# GPS noise around launches and corners
+ALIGNMENT_MIN_REVERSAL_KM = 0.03
+
+# Alignment modes: projection - points are projected onto the reference in a forward moving window,
+# dtw - dynamic time warping within a band around the projection alignment, for noisy tracks
+ALIGNMENT_MODE_PROJECTION = 'projection'
+ALIGNMENT_MODE_DTW = 'dtw'
+ALIGNMENT_MODES = [ALIGNMENT_MODE_PROJECTION, ALIGNMENT_MODE_DTW]
+
+# Half width of dtw band in reference distance and number of track points whose costs are calculated at once
+ALIGNMENT_DTW_BAND_KM = 0.3
+ALIGNMENT_DTW_BLOCK_SIZE = 1024
+
+# dist - distance along the reference for each point (km), offset - distance from the reference polyline (km)
+TrackAlignment = namedtuple('TrackAlignment', ['dist', 'offset'])
+
+
+class ReferencePolyline:
+    """
+    Reference track as a polyline in local equirectangular projection. Points are projected onto polyline segments
+    and distance along the reference is interpolated within the segment. Matching goes forward by chunks of points,
+    points which are too far from the reference window are searched again through spatial index of the reference
+    track ahead, so alignment recovers after dropouts and detours
+    """
+
+    def __init__(self, reference_track):
+        self.spatial_index = reference_track.spatial_index
+        self.dist_from_start = reference_track.dist_from_start
+
+        self._lat0 = float(np.mean(reference_track.lat))
+        self._lon0 = float(np.mean(reference_track.lon))
+        self._cos_lat0 = np.cos(np.radians(self._lat0))
+        x, y = self._project(reference_track.lat, reference_track.lon)
+
+        # Single point reference is a zero length segment
+        if len(x) == 1:
+            x, y = np.repeat(x, 2), np.repeat(y, 2)
+            self.dist_from_start = np.repeat(self.dist_from_start, 2)
+
+        self._segment_x = x[:-1]
+        self._segment_y = y[:-1]
+        self._segment_dx = np.diff(x)
+        self._segment_dy = np.diff(y)
+        self._segment_length_sq = self._segment_dx ** 2 + self._segment_dy ** 2
+        self.segments_count = len(self._segment_x)
+
+    def align(self, lat, lon, dist):
+        """
+        Aligns track points given by coordinates and distances from previous points (km, as Track.dist).
+        Aligned distance doesn't go back unless the step back is longer than ALIGNMENT_MIN_REVERSAL_KM
+        @:returns TrackAlignment
+        """
+        x, y = self._project(np.asarray(lat), np.asarray(lon))
+        points_count = len(x)
+        aligned_dist = np.empty(points_count)
+        offset = np.empty(points_count)
+
+        last_dist = 0.0
+        start = 0
+        while start < points_count:
+            end = min(start + ALIGNMENT_CHUNK_SIZE, points_count)
+            travelled = np.cumsum(dist[start:end])
+            expected_dist = last_dist + travelled
+
+            first_segment, last_segment = self._get_window_segments(
+                last_dist - ALIGNMENT_WINDOW_BACK_KM, expected_dist[-1] + ALIGNMENT_WINDOW_AHEAD_MARGIN_KM
+            )
+            chunk_offset, chunk_dist = self._project_to_segments(
+                x[start:end], y[start:end], slice(first_segment, last_segment)
+            )
+            score = chunk_offset + ALIGNMENT_PROGRESS_WEIGHT * np.abs(chunk_dist - expected_dist[:, np.newaxis])
+            best = np.argmin(score, axis=1)
+            rows = np.arange(end - start)
+            aligned_dist[start:end] = chunk_dist[rows, best]
+            offset[start:end] = chunk_offset[rows, best]
+
+            lost = np.flatnonzero(offset[start:end] > POINT_MAX_DISTANCE_THRESHOLD_KM)
+            if len(lost) > 0:
+                lost_idx = start + int(lost[0])
+                recovered = self._find_ahead(x[lost_idx:lost_idx + 1], y[lost_idx:lost_idx + 1], lat[lost_idx],
+                                             lon[lost_idx], first_segment)
+                if recovered is not None and recovered[0] < offset[lost_idx]:
+                    # Chunk is matched again from the next point, around the recovered position
+                    offset[lost_idx], aligned_dist[lost_idx] = recovered
+                    last_dist = aligned_dist[lost_idx]
+                    start = lost_idx + 1
+                    continue
+
+            last_dist = aligned_dist[end - 1]
+            start = end
+
+        return TrackAlignment(_clamp_steps_back(aligned_dist), offset)
+
+    def align_dtw(self, lat, lon, dist, band_km=ALIGNMENT_DTW_BAND_KM):
+        """
+        Aligns track points with dynamic time warping: each point is matched to a reference segment, segments
+        of consecutive points never go back and the sum of point offsets is minimal. Segments are searched within
+        band_km (Sakoe-Chiba band) around the projection alignment, so cost and memory are O(points x band segments),
+        linear in track length but growing with reference density. Back pointers take a byte per point and band
+        segment while band has up to 256 segments.
+        Noise and spins can't move points back and forth along the reference, unlike the projection alignment
+        @:returns TrackAlignment
+        """
+        x, y = self._project(np.asarray(lat), np.asarray(lon))
+        points_count = len(x)
+        guide_dist = self.align(lat, lon, dist).dist
+
+        # Band of each point starts at band_start segment, band starts never go back
+        band_start = np.searchsorted(self.dist_from_start, guide_dist - band_km, side='right') - 1
+        band_start = np.maximum.accumulate(np.clip(band_start, 0, self.segments_count - 1))
+        band_end = np.clip(np.searchsorted(self.dist_from_start, guide_dist + band_km, side='left'), 0,
+                           self.segments_count)
+        band_size = max(int(np.max(band_end - band_start)), 1)
+        band_offsets = np.arange(band_size)
+
+        # Best previous segment for each point and segment of its band, as offset in the band of the previous point
+        previous_offsets = np.empty((points_count, band_size), dtype=np.min_scalar_type(band_size - 1))
+        previous_cost = None
+        for block_start in range(0, points_count, ALIGNMENT_DTW_BLOCK_SIZE):
+            block_end = min(block_start + ALIGNMENT_DTW_BLOCK_SIZE, points_count)
+            segments = np.minimum(band_start[block_start:block_end, np.newaxis] + band_offsets, self.segments_count - 1)
+            block_offsets, _ = self._project_to_segments(x[block_start:block_end], y[block_start:block_end], segments)
+
+            for i in range(block_start, block_end):
+                if previous_cost is None:
+                    previous_cost = block_offsets[0]
+                    continue
+
+                # Best cost of the previous point among segments up to each segment
+                prefix_min_cost = np.minimum.accumulate(previous_cost)
+                prefix_min_offset = np.maximum.accumulate(np.where(previous_cost == prefix_min_cost, band_offsets, 0))
+                previous_band_offsets = np.minimum(segments[i - block_start] - band_start[i - 1], band_size - 1)
+
+                previous_offsets[i] = prefix_min_offset[previous_band_offsets]
+                previous_cost = block_offsets[i - block_start] + prefix_min_cost[previous_band_offsets]
+
+        path = np.empty(points_count, dtype=np.int64)
+        path[-1] = min(band_start[-1] + int(np.argmin(previous_cost)), self.segments_count - 1)
+        for i in range(points_count - 1, 0, -1):
+            path[i - 1] = band_start[i - 1] + previous_offsets[i, min(path[i] - band_start[i], band_size - 1)]
+
+        # Points matched to the same segment can still be projected back within it
+        offsets, dists = self._project_to_segments(x, y, path[:, np.newaxis])
+        return TrackAlignment(np.maximum.accumulate(dists[:, 0]), offsets[:, 0])
+
+    def _project(self, lat, lon):
+        """Local equirectangular projection, km"""
+        x = EARTH_RADIUS * self._cos_lat0 * np.radians(lon - self._lon0)
+        y = EARTH_RADIUS * np.radians(lat - self._lat0)
+        return x, y
+
+    def _get_window_segments(self, min_dist, max_dist):
+        """@:returns range [first, last) of segments overlapping given reference distances, at least one segment"""
+        first_segment = int(np.searchsorted(self.dist_from_start, min_dist, side='right')) - 1
+        first_segment = min(max(first_segment, 0), self.segments_count - 1)
+        last_segment = int(np.searchsorted(self.dist_from_start, max_dist, side='left'))
+        last_segment = min(max(last_segment, first_segment + 1), self.segments_count)
+        return first_segment, last_segment
+
+    def _project_to_segments(self, x, y, segments):
+        """
+        Segments are a slice or an array of segment indices, shared by all points, or a matrix of segment indices
+        with a row for each point
+        @:returns matrices (points x segments) of distances to segments and reference distances of projections
+        """
+        dx = x[:, np.newaxis] - self._segment_x[segments]
+        dy = y[:, np.newaxis] - self._segment_y[segments]
+        segment_dx = self._segment_dx[segments]
+        segment_dy = self._segment_dy[segments]
+        length_sq = self._segment_length_sq[segments]
+
+        t = np.zeros(dx.shape)
+        np.divide(dx * segment_dx + dy * segment_dy, length_sq, out=t, where=length_sq > 0)
+        np.clip(t, 0.0, 1.0, out=t)
+
+        offsets = np.hypot(dx - t * segment_dx, dy - t * segment_dy)
+        segment_start_dist = self.dist_from_start[:-1][segments]
+        segment_end_dist = self.dist_from_start[1:][segments]
+        dists = segment_start_dist + t * (segment_end_dist - segment_start_dist)
+        return offsets, dists
+
+    def _find_ahead(self, x, y, lat, lon, first_segment):
+        """
+        Searches segments from the first_segment to the reference end which are close to the point
+        @:returns tuple of offset and reference distance of the closest projection or None
+        """
+        vertices = self.spatial_index.within_radius(lat, lon, POINT_MAX_DISTANCE_THRESHOLD_KM, first_segment)
+        if len(vertices) == 0:
+            return None
+
+        # Segments ending or starting at close vertices
+        segments = np.unique(np.clip(np.concatenate([vertices - 1, vertices]), first_segment, self.segments_count - 1))
+        offsets, dists = self._project_to_segments(x, y, segments)
+        closest = int(np.argmin(offsets[0]))
+        return float(offsets[0, closest]), float(dists[0, closest])
+
+
+def _clamp_steps_back(dist):
+    """Running maximum of distances, restarted at points which are farther than ALIGNMENT_MIN_REVERSAL_KM behind it"""
+    clamped = np.empty(len(dist))
+    start = 0
+    while start < len(dist):
+        running_max = np.maximum.accumulate(dist[start:])
+        reversals = np.flatnonzero(dist[start:] < running_max - ALIGNMENT_MIN_REVERSAL_KM)
+        end = start + int(reversals[0]) if len(reversals) > 0 else len(dist)
+        clamped[start:end] = running_max[:end - start]
+        start = end
+
+    return clamped
@@ -0,0 +1,92 @@
+import numpy as np
+
+from gpstools.utils import MICROS_IN_SECOND
+
+RESAMPLING_GRID_STEP_KM = 0.01
+
+
+class ResampledTracks:
+    """
+    Aligned tracks interpolated onto a common grid of distances along the reference, so tracks are compared
+    with array operations on grid values instead of point searches.
+    dist - grid distances (km), names - track names, finished - whether tracks reached the finish,
+    time - tracks x grid matrix of seconds from the start, speed - tracks x grid matrix of speeds (kph),
+    reference_time - seconds from the start of the reference track. Grid points not reached by a track are NaN
+    """
+
+    def __init__(self, dist, names, finished, time, speed, reference_time):
+        self.dist = dist
+        self.names = names
+        self.finished = finished
+        self.time = time
+        self.speed = speed
+        self.reference_time = reference_time
+
+    def get_time_delta_to_reference(self):
+        """@:returns tracks x grid matrix of seconds gained (negative) or lost (positive) to the reference track"""
+        return self.time - self.reference_time
+
+    def get_time_delta_to_best(self):
+        """@:returns tracks x grid matrix of seconds lost to the fastest track at each grid distance"""
+        if len(self.names) == 0:
+            return self.time.copy()
+
+        # Grid points not reached by any track stay NaN, without warnings of nanmin
+        reached = np.any(~np.isnan(self.time), axis=0)
+        best_time = np.full(len(self.dist), np.nan)
+        best_time[reached] = np.nanmin(self.time[:, reached], axis=0)
+        return self.time - best_time
+
+    def get_time_delta(self, track_idx, other_track_idx):
+        """@:returns seconds lost by the track to the other track at each grid distance"""
+        return self.time[track_idx] - self.time[other_track_idx]
+
+
+def resample_aligned_tracks(reference_track, aligned_tracks, grid_step_km=RESAMPLING_GRID_STEP_KM):
+    """
+    Interpolates time and speed of SSAnalysisTrack list onto distances from the reference start to its finish.
+    Finished tracks are cut at the first point within the finish radius, short of the reference finish, so the grid
+    ends at the shortest distance reached by finished tracks and all of them have values at the last grid point
+    @:returns ResampledTracks
+    """
+    dists = [np.array([p.dist for p in track.points]) for track in aligned_tracks]
+
+    end_dist = float(reference_track.dist_from_start[-1])
+    finished_end_dists = [
+        float(np.max(dist)) for dist, track in zip(dists, aligned_tracks) if track.is_finished and len(dist) > 0
+    ]
+    if len(finished_end_dists) > 0:
+        end_dist = min(end_dist, min(finished_end_dists))
+    grid = np.append(np.arange(0.0, end_dist, grid_step_km), end_dist)
+
+    time = np.empty((len(aligned_tracks), len(grid)))
+    speed = np.empty((len(aligned_tracks), len(grid)))
+    for i, track in enumerate(aligned_tracks):
+        time[i] = _interpolate_by_dist(dists[i], np.array([p.micros for p in track.points]) / MICROS_IN_SECOND, grid)
+        speed[i] = _interpolate_by_dist(dists[i], np.array([p.speed for p in track.points]), grid)
+
+    finished = np.array([track.is_finished for track in aligned_tracks], dtype=bool)
+    assert np.all(np.isfinite(time[finished, -1])), "Finished tracks should reach the end of the grid"
+
+    reference_time = _interpolate_by_dist(
+        reference_track.dist_from_start, reference_track.micros_from_start / MICROS_IN_SECOND, grid
+    )
+
+    return ResampledTracks(
+        dist=grid,
+        names=[track.name for track in aligned_tracks],
+        finished=[track.is_finished for track in aligned_tracks],
+        time=time,
+        speed=speed,
+        reference_time=reference_time
+    )
+
+
+def _interpolate_by_dist(dist, values, grid):
+    """
+    Values at grid distances, taken when the track first reached them. Distance can step back (spins), points before
+    the track gets back to its previous maximum are skipped. Grid points after the track end are NaN
+    """
+    max_dist = np.maximum.accumulate(dist)
+    is_new_max = np.concatenate([[True], max_dist[1:] > max_dist[:-1]])
+    return np.interp(grid, max_dist[is_new_max], values[is_new_max], right=np.nan)
@@ -1,17 +1,30 @@
-from haversine import haversine
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 from gpstools.config import POINT_DISTANCE_THRESHOLD_KM
+from gpstools.ss_analysis.alignment import ALIGNMENT_MODE_DTW, ALIGNMENT_MODE_PROJECTION, ALIGNMENT_MODES, \
+    ReferencePolyline
+from gpstools.ss_analysis.resampling import RESAMPLING_GRID_STEP_KM, resample_aligned_tracks
 from gpstools.track.activity_detection import DEFAULT_ACTIVITY_DETECTION_PARAMS, get_activity_segments_for_track
 from gpstools.track.speed_calculation import DEFAULT_SPEED_PARAMS
-from gpstools.track.track import Track
-from gpstools.utils import get_dist
-from gpstools.viz import generate_ss_analysis_graph
-
-POINT_ALIGNMENT_SEARCH_WINDOW = 50
+from gpstools.track.utils import get_sparse_track_indices
+from gpstools.utils import get_dist, get_dists, lazy_property
+from gpstools.viz import generate_ss_analysis_graph, update_ss_analysis_graph, get_ss_track_data_json
 
 MAP_POINTS_MIN_DIST_KM = 0.05
 TRACK_POINT_SEARCH_RADIUS_KM = 0.025
 
+# How speed comparison points are built from samples where some tracks have no close point:
+# drop_point - such samples are skipped, keep_point - samples are kept with None speeds when any track has a speed
+MISSING_SPEEDS_DROP_POINT = 'drop_point'
+MISSING_SPEEDS_KEEP_POINT = 'keep_point'
+
+# Activity segment of a track starting at the reference start, finish_idx - index of the finish point in the track
+# cropped from the segment start or None when the finish is not reached
+SelectedSegment = namedtuple('SelectedSegment', ['activity_segment', 'name', 'finish_idx'])
+
 
 class SSAnalysisTrackPoint:
 
@@ -67,7 +80,63 @@ class SpeedComparisonPoint:
         self.speeds = speeds
 
 
+class SpeedComparisonMatrix:
+    """
+    Speeds of all tracks at reference samples. lat, lon - sample coordinates, speeds - samples x tracks matrix (kph),
+    valid - mask of speeds taken from track points within TRACK_POINT_SEARCH_RADIUS_KM, other speeds are NaN
+    """
+
+    def __init__(self, lat, lon, speeds, valid):
+        self.lat = lat
+        self.lon = lon
+        self.speeds = speeds
+        self.valid = valid
+
+    def to_speed_comparison_points(self, missing_speeds_policy=MISSING_SPEEDS_DROP_POINT):
+        """@:returns list of SpeedComparisonPoint, missing_speeds_policy is one of MISSING_SPEEDS_* values"""
+        if missing_speeds_policy == MISSING_SPEEDS_DROP_POINT:
+            samples = np.flatnonzero(np.all(self.valid, axis=1))
+        elif missing_speeds_policy == MISSING_SPEEDS_KEEP_POINT:
+            samples = np.flatnonzero(np.any(self.valid, axis=1))
+        else:
+            raise ValueError("Unknown missing speeds policy %s" % missing_speeds_policy)
+
+        speeds = self.speeds[samples].tolist()
+        valid = self.valid[samples].tolist()
+        return [
+            SpeedComparisonPoint(
+                lat=float(self.lat[sample]),
+                lon=float(self.lon[sample]),
+                speeds=[speed if is_valid else None for speed, is_valid in zip(sample_speeds, sample_valid)]
+            )
+            for sample, sample_speeds, sample_valid in zip(samples.tolist(), speeds, valid)
+        ]
+
+
+class SSAnalysisTrackResult:
+    """
+    Results cached by the graph for a selected track segment: source_name - name of the track given to the graph,
+    track - cropped track, aligned_track - SSAnalysisTrack, comparison_speeds and comparison_valid - its column
+    of the speed comparison matrix
+    """
+
+    def __init__(self, source_name, track, aligned_track, comparison_speeds, comparison_valid):
+        self.source_name = source_name
+        self.track = track
+        self.aligned_track = aligned_track
+        self.comparison_speeds = comparison_speeds
+        self.comparison_valid = comparison_valid
+
+    @lazy_property
+    def data_json(self):
+        return get_ss_track_data_json(self.aligned_track)
+
+
 class SSAnalysisGraph:
+    """
+    Tracks can be added and removed after the graph is built, results of other tracks are kept, so only new tracks
+    are aligned. Comparison matrix, points and json output are assembled from results cached for each track
+    """
 
     def __init__(
             self,
@@ -75,32 +144,105 @@ class SSAnalysisGraph:
             reference_track,
             speed_params=DEFAULT_SPEED_PARAMS,
             activity_detection_params=DEFAULT_ACTIVITY_DETECTION_PARAMS,
-            point_distance_threshold_km=POINT_DISTANCE_THRESHOLD_KM):
+            point_distance_threshold_km=POINT_DISTANCE_THRESHOLD_KM,
+            workers=1,
+            missing_speeds_policy=MISSING_SPEEDS_DROP_POINT,
+            alignment_mode=ALIGNMENT_MODE_PROJECTION):
+        """
+        @:param workers - number of processes selecting segments and aligning tracks in parallel, 1 does everything
+        in current process, None uses all available cores. Results are the same in both modes
+        @:param missing_speeds_policy - how speed_comparison_points treat samples missed by some tracks, full data
+        is kept in speed_comparison_matrix
+        @:param alignment_mode - one of ALIGNMENT_MODE_* values, dtw is slower but keeps noisy tracks (i.e. 1hz phone
+        recordings) moving forward along the reference
+        """
+        self._init_reference(reference_track, speed_params, activity_detection_params, point_distance_threshold_km,
+                             alignment_mode)
+        self.missing_speeds_policy = missing_speeds_policy
+
+        # Reference samples of speed comparison matrix
+        samples = get_sparse_track_indices(reference_track, MAP_POINTS_MIN_DIST_KM)
+        self._sample_lat = reference_track.lat[samples]
+        self._sample_lon = reference_track.lon[samples]
+        self._sample_dist = reference_track.dist_from_start[samples]
+
+        self._track_results = []
+        self.add_tracks(tracks, workers)
+
+    def add_tracks(self, tracks, workers=1):
+        """
+        Selects segments of given tracks and aligns them, results of tracks added before are kept.
+        Tracks with names already added to the graph replace previous ones
+        @:param workers - see __init__
+        """
+        names = set(track.name for track in tracks)
+        self._track_results = [result for result in self._track_results if result.source_name not in names]
+
+        new_results = []
+        if workers == 1 or len(tracks) <= 1:
+            for track in tracks:
+                for selected_segment, cropped_track in self._select_track_segments(track):
+                    aligned_track = self._align_track(cropped_track, selected_segment.finish_idx is not None)
+                    new_results.append(self._get_track_result(track.name, cropped_track, aligned_track))
+        else:
+            # Reference is sent to each worker once, tracks are sent one by one
+            with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker_graph,
+                    initargs=(self.reference_track, self.speed_params, self.activity_detection_params,
+                              self.point_distance_threshold_km, self.alignment_mode)
+            ) as executor:
+                for track, results in zip(tracks, executor.map(_select_and_align_track_in_worker, tracks)):
+                    for selected_segment, aligned_track in results:
+                        cropped_track = _crop_selected_segment(track, selected_segment)
+                        new_results.append(self._get_track_result(track.name, cropped_track, aligned_track))
+
+        print("Found %d tracks out of %d initial tracks" % (len(new_results), len(tracks)))
+
+        self._track_results.extend(new_results)
+        self._update_comparison()
+
+    def remove_track(self, name):
+        """Removes all segments of the track with given name, as it was given to the graph"""
+        track_results = [result for result in self._track_results if result.source_name != name]
+        if len(track_results) == len(self._track_results):
+            print("Track %s is not in the graph" % name)
+            return
+
+        self._track_results = track_results
+        self._update_comparison()
+
+    def _get_track_result(self, source_name, track, aligned_track):
+        comparison_speeds, comparison_valid = self._get_comparison_speeds(track, aligned_track)
+        return SSAnalysisTrackResult(source_name, track, aligned_track, comparison_speeds, comparison_valid)
+
+    def _update_comparison(self):
+        """Assembles track lists and speed comparison from cached track results"""
+        self.tracks = [result.track for result in self._track_results]
+        self.aligned_tracks = [result.aligned_track for result in self._track_results]
+
+        speeds = np.empty((len(self._sample_lat), len(self._track_results)))
+        valid = np.empty((len(self._sample_lat), len(self._track_results)), dtype=bool)
+        for i, result in enumerate(self._track_results):
+            speeds[:, i] = result.comparison_speeds
+            valid[:, i] = result.comparison_valid
+
+        self.speed_comparison_matrix = SpeedComparisonMatrix(self._sample_lat, self._sample_lon, speeds, valid)
+        self.speed_comparison_points = self.speed_comparison_matrix.to_speed_comparison_points(
+            self.missing_speeds_policy
+        )
+
+    def _init_reference(self, reference_track, speed_params, activity_detection_params, point_distance_threshold_km,
+                        alignment_mode):
+        if alignment_mode not in ALIGNMENT_MODES:
+            raise ValueError("Unknown alignment mode %s" % alignment_mode)
+
         self.reference_track = reference_track
         self.speed_params = speed_params
         self.activity_detection_params = activity_detection_params
         self.point_distance_threshold_km = point_distance_threshold_km
-        self.tracks, tracks_finished = self._select_segments_by_reference_track(tracks)
-        self.speed_comparison_points = self._build_speed_comparison_points(reference_track, self.tracks)
-
-        print("Found %d tracks out of %d initial tracks" % (len(self.tracks), len(tracks)))
-
-        self.aligned_tracks = []
-        for i, original_track in enumerate(self.tracks):
-            track = Track(
-                original_track.name,
-                original_track.points,
-                speed_params=self.speed_params,
-                norm_params=None
-            )
-
-            aligned_track = self._align_track_along_reference(
-                self.reference_track,
-                track,
-                tracks_finished[i]
-            )
-
-            self.aligned_tracks.append(aligned_track)
+        self.alignment_mode = alignment_mode
+        self.reference_polyline = ReferencePolyline(reference_track)
 
     def print_stats(self):
         print("Comparing %d tracks" % len(self.aligned_tracks))
@@ -109,50 +251,42 @@ class SSAnalysisGraph:
             self.aligned_tracks[i].print_stats()
 
     def build_comparison_graph(self, name, title):
-        generate_ss_analysis_graph(name, title, self.reference_track, self.aligned_tracks, self.speed_comparison_points)
+        generate_ss_analysis_graph(name, title, self.reference_track, self.aligned_tracks, self.speed_comparison_points,
+                                   [result.data_json for result in self._track_results])
+
+    def get_resampled_tracks(self, grid_step_km=RESAMPLING_GRID_STEP_KM):
+        """@:returns ResampledTracks with time and speed of aligned tracks on a common grid of reference distances"""
+        return resample_aligned_tracks(self.reference_track, self.aligned_tracks, grid_step_km)
+
+    def update_comparison_graph(self, name, title):
+        """Rewrites data of the graph built by build_comparison_graph, i.e. after tracks were added or removed"""
+        update_ss_analysis_graph(name, title, self.reference_track, self.aligned_tracks, self.speed_comparison_points,
+                                 [result.data_json for result in self._track_results])
+
+    def _align_track(self, original_track, is_finished):
+        return self._align_track_along_reference(
+            self.reference_track, original_track.with_speed_params(self.speed_params), is_finished
+        )
 
     def _align_track_along_reference(self, reference_track, track, is_finished):
         """
-            Tries to find closest points in track along reference points
-            same_point_dist_threshold - points within this threshold counts as the same for reference points
-            dist_threshold_max - helps us understand that we moved far away from ref point
+            Projects track points onto reference polyline, distance of each point is the distance along reference
+            track to its projection. Points farther than point_distance_threshold_km from reference are off the track
         """
 
-        ref_points = reference_track.points
-        saved_ref_idx = 0
-        filtered_points = []
-        missed_points_count = 0
-        for i, point in enumerate(track.points):
-            # Adding candidate points
-            candidate_points = []
-            closest_ref_point_idx = 0
-            min_dist = 100000000  # Max value as a stub
-
-            # min_ref_idx = max(saved_ref_idx - POINT_ALIGNMENT_SEARCH_WINDOW, 0)
-            min_ref_idx = saved_ref_idx  # Searching points only after previous (strange behaviour in case of spins)
-            max_ref_idx = min(saved_ref_idx + POINT_ALIGNMENT_SEARCH_WINDOW, len(ref_points))
-
-            for ref_idx in range(min_ref_idx, max_ref_idx):
-                dist_from_ref = get_dist(point, ref_points[ref_idx])
-                candidate_points.append(ref_points[ref_idx])
-                if dist_from_ref < min_dist:
-                    min_dist = dist_from_ref
-                    closest_ref_point_idx = ref_idx
-                ref_idx += 1
-
-            saved_ref_idx = closest_ref_point_idx
-
-            if min_dist > self.point_distance_threshold_km:
-                missed_points_count += 1
-
-            filtered_points.append(SSAnalysisTrackPoint(
-                idx=i,
-                lat=point.lat,
-                lon=point.lon,
-                speed=track.speed[i],
-                dist=reference_track.dist_from_start[closest_ref_point_idx],
-                micros=track.micros_from_start[i]
+        if self.alignment_mode == ALIGNMENT_MODE_DTW:
+            alignment = self.reference_polyline.align_dtw(track.lat, track.lon, track.dist)
+        else:
+            alignment = self.reference_polyline.align(track.lat, track.lon, track.dist)
+        missed_points_count = int(np.count_nonzero(alignment.offset > self.point_distance_threshold_km))
+
+        filtered_points = [
+            SSAnalysisTrackPoint(idx=i, lat=lat, lon=lon, speed=speed, dist=dist, micros=micros)
+            for i, (lat, lon, speed, dist, micros) in enumerate(zip(
+                track.lat.tolist(), track.lon.tolist(), track.speed.tolist(), alignment.dist.tolist(),
+                track.micros_from_start.tolist()
             ))
+        ]
 
         print("Done dist alignment for track %s, %d points are off the track" % (track.name, missed_points_count))
 
@@ -168,87 +302,92 @@ class SSAnalysisGraph:
         )
         return aligned_track
 
-    def _select_segments_by_reference_track(self, tracks):
-        cropped_tracks = []
-        tracks_finished = []
+    def _select_track_segments(self, track):
+        """@:returns list of SelectedSegment and cropped track for segments starting at the reference start"""
+        selected_segments = []
 
         start_point = self.reference_track.points[0]
         finish_point = self.reference_track.points[-1]
 
-        for track in tracks:
-            segment_id = 1
-            for segment in get_activity_segments_for_track(track, self.activity_detection_params):
-                start_coords = segment.start_point.get_coords()
-                if get_dist(start_coords, start_point.get_coords()) < self.point_distance_threshold_km:
-                    name_postfix = ""
-                    if segment_id > 1:
-                        name_postfix = "_#" + str(segment_id)
+        segment_id = 1
+        for segment in get_activity_segments_for_track(track, self.activity_detection_params):
+            start_coords = segment.start_point.get_coords()
+            if get_dist(start_coords, start_point.get_coords()) < self.point_distance_threshold_km:
+                name_postfix = ""
+                if segment_id > 1:
+                    name_postfix = "_#" + str(segment_id)
 
-                    track_by_segment = track.crop_to_activity_segment_start(segment, track.name + name_postfix)
-                    finish_index = track_by_segment.find_point_index(finish_point)
+                track_by_segment = track.crop_to_activity_segment_start(segment, track.name + name_postfix)
 
-                    if finish_index is None:
-                        cropped_track = track_by_segment
-                        tracks_finished.append(False)
-                    else:
-                        cropped_track = track_by_segment.crop_to_point_idx(finish_index)
-                        tracks_finished.append(True)
+                # Searching on the whole track, so its spatial index is shared by all segments
+                finish_index = track.find_point_index(finish_point, segment.start_idx)
 
-                    cropped_tracks.append(cropped_track)
+                if finish_index is None:
+                    selected_segment = SelectedSegment(segment, track_by_segment.name, None)
+                    cropped_track = track_by_segment
+                else:
+                    # Cropped track can start with additional minute start point
+                    added_points = track_by_segment.len - (track.len - segment.start_idx)
+                    selected_segment = SelectedSegment(
+                        segment, track_by_segment.name, finish_index - segment.start_idx + added_points
+                    )
+                    cropped_track = track_by_segment.crop_to_point_idx(selected_segment.finish_idx)
 
-                    segment_id += 1
+                selected_segments.append((selected_segment, cropped_track))
 
-        return cropped_tracks, tracks_finished
+                segment_id += 1
 
-    def _build_speed_comparison_points(self, reference_track, tracks):
+        return selected_segments
+
+    def _get_comparison_speeds(self, track, aligned_track):
         """
-            Selects sparse subset of reference track points and finds speeds of closest points of
-            all tracks in comparison. If we don't have close point for any of comparison tracks, point is discarded
-            from sparse subset
+            Finds speeds of the closest track points for reference samples, which are reference points at least
+            MAP_POINTS_MIN_DIST_KM apart. Track points are searched around the sample distance along reference,
+            so tracks passing the same place several times take the right pass
+            @:returns column of speed comparison matrix and its validity mask
         """
-
-        track_indices = [0] * len(tracks)
-        map_points = []
-
-        for ref_idx, ref_point in enumerate(reference_track.points):
-            if len(map_points) == 0 or get_dist(map_points[-1], ref_point) > MAP_POINTS_MIN_DIST_KM:
-                speeds = []
-                all_speeds_found = True
-
-                # Searching for closest point to ref_point in each track
-                for track_id, track in enumerate(tracks):
-                    min_idx = track_indices[track_id]
-
-                    if min_idx == track.len:
-                        # When we already traversed track to the end
-                        continue
-
-                    # Copy-paste from '_align_track_along_reference', but let it be so
-                    closest_idx = 0
-                    min_dist = 100000000  # Max value as a stub
-                    max_idx = min(min_idx + POINT_ALIGNMENT_SEARCH_WINDOW, track.len)
-
-                    for idx in range(min_idx, max_idx):
-                        dist_from_ref = get_dist(ref_point, track.points[idx])
-                        if dist_from_ref < min_dist:
-                            min_dist = dist_from_ref
-                            closest_idx = idx
-
-                    if closest_idx != 0:
-                        track_indices[track_id] = closest_idx
-
-                    if min_dist <= TRACK_POINT_SEARCH_RADIUS_KM:
-                        # We've found suitable point
-                        speeds.append(track.speed[closest_idx])  # Already in kph
-                    else:
-                        all_speeds_found = False
-                        break
-
-                if all_speeds_found:
-                    map_points.append(SpeedComparisonPoint(
-                        lat = ref_point.lat,
-                        lon = ref_point.lon,
-                        speeds = speeds
-                    ))
-
-        return map_points
+        # Aligned distance can step back (spins), points are searched on its running maximum
+        aligned_dist = np.maximum.accumulate([p.dist for p in aligned_track.points])
+
+        # Closest of the last point before the sample distance and the first one after it
+        after = np.minimum(np.searchsorted(aligned_dist, self._sample_dist), track.len - 1)
+        before = np.maximum(after - 1, 0)
+        dists_after = get_dists(self._sample_lat, self._sample_lon, track.lat[after], track.lon[after])
+        dists_before = get_dists(self._sample_lat, self._sample_lon, track.lat[before], track.lon[before])
+        closest = np.where(dists_before < dists_after, before, after)
+
+        valid = np.minimum(dists_before, dists_after) <= TRACK_POINT_SEARCH_RADIUS_KM
+        speeds = np.full(len(self._sample_dist), np.nan)
+        speeds[valid] = track.speed[closest[valid]]  # Already in kph
+        return speeds, valid
+
+
+def _crop_selected_segment(track, selected_segment):
+    """Same crop as made by SSAnalysisGraph._select_track_segments"""
+    cropped_track = track.crop_to_activity_segment_start(selected_segment.activity_segment, selected_segment.name)
+    if selected_segment.finish_idx is not None:
+        cropped_track = cropped_track.crop_to_point_idx(selected_segment.finish_idx)
+    return cropped_track
+
+
+# Graph with reference and params only, created in each worker process by _init_worker_graph
+_worker_graph = None
+
+
+def _init_worker_graph(reference_track, speed_params, activity_detection_params, point_distance_threshold_km,
+                       alignment_mode):
+    global _worker_graph
+    _worker_graph = SSAnalysisGraph.__new__(SSAnalysisGraph)
+    _worker_graph._init_reference(reference_track, speed_params, activity_detection_params, point_distance_threshold_km,
+                                  alignment_mode)
+
+
+def _select_and_align_track_in_worker(track):
+    """
+    Cropped tracks are views over the whole track, so only selected segments are returned to the main process
+    to be cropped there again
+    """
+    return [
+        (selected_segment, _worker_graph._align_track(cropped_track, selected_segment.finish_idx is not None))
+        for selected_segment, cropped_track in _worker_graph._select_track_segments(track)
+    ]
@@ -0,0 +1,247 @@
+"""
+Bulk decoding of timestamp columns into wall-clock microseconds since epoch (see TrackPointArray).
+Layout is detected from the first rows and cached by the shape of the first value, cached layout is checked against
+the first rows of each column, so ambiguous dates of one file don't decide the order of day and month for another.
+The rest of the column is parsed in bulk. Rows which do not fit the detected layout are parsed with dateutil, as before
+"""
+import re
+from functools import partial
+from datetime import datetime, timedelta, timezone
+
+import dateutil.parser
+import numpy as np
+
+from gpstools.utils import EPOCH, MICROS_IN_SECOND, get_fixed_tzinfo, datetime_to_micros
+
+TIMESTAMP_SAMPLE_ROWS = 20
+
+# ISO-8601 date and time or time only (date defaults to today, same as dateutil does)
+ISO_TIMESTAMP_PATTERN = re.compile(
+    r'^(?:(\d{4})-(\d{2})-(\d{2})[T ])?(\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?(Z|[+-]\d{2}:?\d{2})?$',
+    re.MULTILINE
+)
+
+# Formats checked against dateutil on the first rows when the column is not ISO-8601
+STRPTIME_FORMATS = [
+    '%d.%m.%Y %H:%M:%S.%f',
+    '%d.%m.%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M:%S.%f',
+    '%d/%m/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M:%S.%f',
+    '%m/%d/%Y %H:%M:%S',
+]
+
+# Epoch seconds are converted to local time with offsets calculated once per bucket (DST changes are aligned to it)
+LOCAL_OFFSET_BUCKET_SECONDS = 900
+
+_decoders_cache = {}
+
+# Names of fixes applied by repair_timestamps
+TIMESTAMP_FIX_MILLIS_SCALE = 'millis_scale'
+TIMESTAMP_FIX_SUBSECOND_PRECISION = 'subsecond_precision'
+
+# Step of restored subsecond precision, up to 10 points in a second
+RESTORED_SUBSECOND_STEP_MICROS = 100000
+
+
+def decode_timestamps(values):
+    """
+    Decodes list of timestamp strings
+    @:returns tuple of int64 array with wall-clock micros and fixed-offset tzinfo of the first timestamp
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), None
+
+    shape = re.sub(r'\d', '0', values[0])
+    sample = values[:TIMESTAMP_SAMPLE_ROWS]
+    decoder = _decoders_cache.get(shape)
+    if decoder is None or not _is_decoder_matching(decoder, sample):
+        decoder = _detect_decoder(sample)
+        _decoders_cache[shape] = decoder
+
+    return decoder(values)
+
+
+def decode_epoch_seconds(seconds):
+    """Decodes epoch seconds into naive local wall-clock micros, same as datetime.fromtimestamp does per value"""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    whole_seconds = seconds.astype(np.int64)
+    micros = (seconds % 1 * MICROS_IN_SECOND).astype(np.int64)
+
+    buckets, bucket_indices = np.unique(whole_seconds // LOCAL_OFFSET_BUCKET_SECONDS, return_inverse=True)
+    bucket_offsets = np.array([
+        _get_local_offset_seconds(int(bucket) * LOCAL_OFFSET_BUCKET_SECONDS) for bucket in buckets
+    ], dtype=np.int64)
+
+    return (whole_seconds + bucket_offsets[bucket_indices.reshape(-1)]) * MICROS_IN_SECOND + micros
+
+
+def _get_local_offset_seconds(timestamp):
+    local_delta = datetime.fromtimestamp(timestamp) - EPOCH
+    return local_delta.days * 86400 + local_delta.seconds - timestamp
+
+
+def _detect_decoder(sample):
+    if all(ISO_TIMESTAMP_PATTERN.match(value) for value in sample):
+        return _decode_iso_timestamps
+
+    for time_format in STRPTIME_FORMATS:
+        if _is_format_matching_dateutil(sample, time_format):
+            return partial(_decode_with_strptime, time_format=time_format)
+
+    return _decode_with_dateutil
+
+
+def _is_decoder_matching(decoder, sample):
+    """Checks decoder detected for another column, dateutil decoder fits any column"""
+    if decoder is _decode_iso_timestamps:
+        return all(ISO_TIMESTAMP_PATTERN.match(value) for value in sample)
+    if isinstance(decoder, partial):
+        return _is_format_matching_dateutil(sample, decoder.keywords['time_format'])
+    return True
+
+
+def _is_format_matching_dateutil(sample, time_format):
+    try:
+        return all(datetime.strptime(value, time_format) == dateutil.parser.parse(value) for value in sample)
+    except ValueError:
+        return False
+
+
+def _parse_with_dateutil(values, row_offset=0):
+    times = []
+    for i, value in enumerate(values):
+        try:
+            times.append(dateutil.parser.parse(value))
+        except (ValueError, OverflowError):
+            raise ValueError("Cannot parse timestamp in row %d: %s" % (row_offset + i + 1, value))
+
+    return times
+
+
+def _decode_with_dateutil(values):
+    times = _parse_with_dateutil(values)
+    tzinfo = get_fixed_tzinfo(times[0])
+    return np.array([datetime_to_micros(t, tzinfo) for t in times], dtype=np.int64), tzinfo
+
+
+def _decode_with_strptime(values, time_format):
+    times = []
+    for i, value in enumerate(values):
+        try:
+            times.append(datetime.strptime(value, time_format))
+        except ValueError:
+            times.extend(_parse_with_dateutil([value], row_offset=i))
+
+    tzinfo = get_fixed_tzinfo(times[0])
+    return np.array([datetime_to_micros(t, tzinfo) for t in times], dtype=np.int64), tzinfo
+
+
+def _decode_iso_timestamps(values):
+    # Single regex pass over the whole column, row alignment is checked by matches count
+    matches = ISO_TIMESTAMP_PATTERN.findall('\n'.join(values))
+    if len(matches) == len(values):
+        matched_rows = None
+    else:
+        matched_rows = [i for i, value in enumerate(values) if ISO_TIMESTAMP_PATTERN.match(value)]
+
+    micros = np.zeros(len(values), dtype=np.int64)
+    offsets = np.zeros(len(values), dtype=np.int64)
+    is_aware = np.zeros(len(values), dtype=bool)
+
+    if len(matches) > 0:
+        columns = list(zip(*matches))
+        year, month, day, hour, minute, second, fraction, tz = [np.array(column) for column in columns]
+
+        has_date = year != ''
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        dates = np.full(len(matches), np.datetime64(today, 'D'))
+        if np.any(has_date):
+            dates[has_date] = (
+                (year[has_date].astype(np.int64) - 1970) * 12 + month[has_date].astype(np.int64) - 1
+            ).astype('datetime64[M]').astype('datetime64[D]') + (day[has_date].astype(np.int64) - 1)
+
+        # Fraction digits after microseconds are truncated, same as dateutil does
+        fraction_micros = np.char.ljust(fraction.astype('<U6'), 6, '0').astype(np.int64)
+        matched_micros = \
+            dates.astype(np.int64) * 86400 * MICROS_IN_SECOND + \
+            (hour.astype(np.int64) * 3600 + minute.astype(np.int64) * 60 + second.astype(np.int64)) * \
+            MICROS_IN_SECOND + fraction_micros
+
+        matched_is_aware = tz != ''
+        tz_values, tz_indices = np.unique(tz, return_inverse=True)
+        matched_offsets = np.array(
+            [_parse_tz_offset_seconds(value) for value in tz_values.tolist()], dtype=np.int64
+        )[tz_indices.reshape(-1)]
+
+        target = slice(None) if matched_rows is None else np.array(matched_rows, dtype=np.int64)
+        micros[target] = matched_micros
+        offsets[target] = matched_offsets
+        is_aware[target] = matched_is_aware
+
+    if matched_rows is not None:
+        unmatched_rows = np.setdiff1d(np.arange(len(values)), matched_rows)
+        for i in unmatched_rows.tolist():
+            time = _parse_with_dateutil([values[i]], row_offset=i)[0]
+            micros[i] = datetime_to_micros(time)
+            is_aware[i] = time.tzinfo is not None
+            offsets[i] = time.utcoffset().total_seconds() if is_aware[i] else 0
+
+    # All timestamps are converted to the timezone of the first one
+    if not is_aware[0]:
+        return micros, None
+
+    tzinfo = timezone(timedelta(seconds=int(offsets[0])))
+    micros[is_aware] += (offsets[0] - offsets[is_aware]) * MICROS_IN_SECOND
+    return micros, tzinfo
+
+
+def _parse_tz_offset_seconds(value):
+    if value == '' or value == 'Z':
+        return 0
+
+    sign = -1 if value[0] == '-' else 1
+    digits = value[1:].replace(':', '')
+    return sign * (int(digits[:2]) * 3600 + int(digits[2:]) * 60)
+
+
+def repair_timestamps(micros):
+    """
+    Repairs logger timestamp errors in place, micros is an int64 array of wall-clock microseconds:
+    Harry's Lap Timer writes milliseconds with a leading zero (.05 instead of .5), fractions are scaled by 10.
+    Some loggers (like XGPS-160 built-in one) miss subsecond precision, points within the same second get 100ms steps,
+    the first second of the track is counted as its last points.
+    @:returns list of applied fixes (TIMESTAMP_FIX_* names)
+    """
+    fixes = []
+    if len(micros) == 0:
+        return fixes
+
+    seconds = micros // MICROS_IN_SECOND
+    fractions = micros - seconds * MICROS_IN_SECOND
+
+    if np.any(fractions > 0) and not np.any(fractions >= MICROS_IN_SECOND // 10):
+        micros += fractions * 9
+        fractions *= 10
+        fixes.append(TIMESTAMP_FIX_MILLIS_SCALE)
+
+    # Groups of consecutive points within the same second
+    group_starts = np.flatnonzero(np.diff(seconds, prepend=seconds[0] - 1) != 0)
+    group_sizes = np.diff(np.append(group_starts, len(micros)))
+    group_has_fractions = np.maximum.reduceat(fractions > 0, group_starts)
+    restored_groups = (group_sizes > 1) & ~group_has_fractions
+
+    if np.any(restored_groups):
+        if np.any(group_sizes[restored_groups] > MICROS_IN_SECOND // RESTORED_SUBSECOND_STEP_MICROS):
+            raise ValueError("Cannot restore subsecond precision for more than 10 points in a second")
+
+        group_offsets = np.zeros(len(group_starts), dtype=np.int64)
+        group_offsets[0] = MICROS_IN_SECOND // RESTORED_SUBSECOND_STEP_MICROS - group_sizes[0]
+
+        group_indices = np.repeat(np.arange(len(group_starts)), group_sizes)
+        restored = restored_groups[group_indices]
+        steps = np.arange(len(micros)) - group_starts[group_indices] + group_offsets[group_indices]
+        micros[restored] += steps[restored] * RESTORED_SUBSECOND_STEP_MICROS
+        fixes.append(TIMESTAMP_FIX_SUBSECOND_PRECISION)
+
+    return fixes
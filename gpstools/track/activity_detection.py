@@ -1,5 +1,9 @@
 from collections import namedtuple
+
+import numpy as np
+
 from gpstools.track.track import TrackActivitySegment
+from gpstools.utils import MICROS_IN_SECOND, MICROS_IN_MINUTE
 
 ActivityDetectionParams = namedtuple('ActivityDetectionParams',
                                      ['align_to_minutes', 'speed_eps', 'segment_max_allow_pause', 'segment_min_duration'])
@@ -13,79 +17,75 @@ DEFAULT_ACTIVITY_DETECTION_PARAMS = ActivityDetectionParams(
 
 
 def get_activity_segments_for_track(track, activity_detection_params=DEFAULT_ACTIVITY_DETECTION_PARAMS):
-    activity_segments = []
+    """
+    Splits track into segments of movement. Runs of points slower than speed_eps are pauses, segment ends at the pause
+    which lasts longer than segment_max_allow_pause. Segment start is moved back either to the minute start
+    (align_to_minutes, for rally specials) or along increasing speed to the start of acceleration.
+    Pauses and start positions are calculated with arrays, so only a loop over found segments is left
+    """
+    params = activity_detection_params
+    speed = np.asarray(track.speed)
+    micros = track.points.micros
+    points_count = track.len
 
-    segment_start_idx = None
-    segment_end_idx = None
-    is_segment_active = False
+    is_slow = speed < params.speed_eps
+    moving_indices = np.flatnonzero(~is_slow)
 
-    def try_add_activity_segment(start_idx, end_idx):
-        segment_duration = (track.points[end_idx].time - track.points[start_idx].time).total_seconds()
+    # Pauses are runs of slow points, pause which ends the segment is detected at its first point too far in time
+    # from the pause start
+    is_pause_start = is_slow & ~np.concatenate([[False], is_slow[:-1]])
+    pause_starts = np.flatnonzero(is_pause_start)
+    slow_indices = np.flatnonzero(is_slow)
+    slow_pause_starts = pause_starts[np.cumsum(is_pause_start)[slow_indices] - 1]
+    is_pause_exceeded = (micros[slow_indices] - micros[slow_pause_starts]) / MICROS_IN_SECOND > \
+        params.segment_max_allow_pause
+    ending_pause_starts, first_exceeded = np.unique(slow_pause_starts[is_pause_exceeded], return_index=True)
+    ending_pause_detections = slow_indices[is_pause_exceeded][first_exceeded]
+
+    # Segment start is moved back from the last point before movement to the first point of its chain
+    if params.align_to_minutes:
+        minutes = micros // MICROS_IN_MINUTE % 60
+        is_chain_start = np.concatenate([[True], minutes[1:] != minutes[:-1]])
+    else:
+        is_chain_start = np.concatenate([[True], ~((0 < speed[:-1]) & (speed[:-1] < speed[1:]))])
+    chain_starts = np.maximum.accumulate(np.where(is_chain_start, np.arange(points_count), 0))
+
+    activity_segments = []
 
-        if segment_duration >= activity_detection_params.segment_min_duration:
-            new_segment = TrackActivitySegment(
+    def try_add_activity_segment(start_idx, end_idx):
+        segment_duration = (micros[end_idx] - micros[start_idx]) / MICROS_IN_SECOND
+        if segment_duration >= params.segment_min_duration:
+            activity_segments.append(TrackActivitySegment(
                 len(activity_segments),
                 start_idx,
                 end_idx,
                 track.points[start_idx],
                 track.points[end_idx]
-            )
-            return [new_segment]
-        else:
-            return []
-
-    for i in range(track.len):
-        if segment_start_idx is None:
-            # Marking current point as a candidate
-            segment_start_idx = i
-            segment_end_idx = None
-            is_segment_active = False
-        else:
-            if track.speed[i] < activity_detection_params.speed_eps:
-                if not is_segment_active:
-                    # Moving segment start forward, no movement
-                    segment_start_idx = i
-                    is_segment_active = False
-                else:
-                    # We detected stop in current active segment, should check whether it's the end
-                    if segment_end_idx is not None:
-                        # We are already stopped, calculating time passed
-                        cur_pause = (track.points[i].time - track.points[segment_end_idx].time).total_seconds()
-                        if cur_pause > activity_detection_params.segment_max_allow_pause:
-                            # If pause is above the threshold, we should end segment
-                            activity_segments.extend(try_add_activity_segment(segment_start_idx, segment_end_idx))
-
-                            segment_start_idx = None
-                            segment_end_idx = None
-                            is_segment_active = False
-
-                    else:
-                        # It's the first stop point, marking it as an end of segment candidate
-                        segment_end_idx = i
+            ))
+
+    # Point which becomes segment start candidate, the next one is the first which can start movement
+    candidate_idx = 0
+    while candidate_idx < points_count:
+        next_moving = np.searchsorted(moving_indices, candidate_idx + 1)
+        if next_moving == len(moving_indices):
+            # No movement till the end, start candidate is moved along slow points to the last one
+            try_add_activity_segment(points_count - 1, points_count - 1)
+            break
+
+        movement_idx = int(moving_indices[next_moving])
+        segment_start_idx = int(chain_starts[movement_idx - 1])
+
+        next_ending_pause = np.searchsorted(ending_pause_starts, movement_idx)
+        if next_ending_pause == len(ending_pause_starts):
+            # Track ends within the segment, possibly with a short pause
+            if is_slow[-1]:
+                segment_end_idx = int(pause_starts[-1])
             else:
-                # We have noticed movement in segment - it should be marked as active and end candidate should be dropped
-                is_segment_active = True
-                segment_end_idx = None
-
-                # We should normalize segment start idx - begin it either from zero speed (start point) or from minute
-                # start (for rally specials)
-                if activity_detection_params.align_to_minutes:
-                    # Normalizing to minute start
-                    cur_minute = track.time[segment_start_idx].minute
-
-                    while segment_start_idx > 0 and track.time[segment_start_idx - 1].minute == cur_minute:
-                        segment_start_idx -= 1
-                else:
-                    # Normalizing to minimal speed
-                    while segment_start_idx > 0 \
-                            and 0 < track.speed[segment_start_idx - 1] < track.speed[segment_start_idx]:
-                        segment_start_idx -= 1
-
-    if segment_start_idx is not None:
-        # Adding last segment
-        if segment_end_idx is None:
-            segment_end_idx = track.len - 1
-
-        activity_segments.extend(try_add_activity_segment(segment_start_idx, segment_end_idx))
+                segment_end_idx = points_count - 1
+            try_add_activity_segment(segment_start_idx, segment_end_idx)
+            break
+
+        try_add_activity_segment(segment_start_idx, int(ending_pause_starts[next_ending_pause]))
+        candidate_idx = int(ending_pause_detections[next_ending_pause]) + 1
 
     return activity_segments
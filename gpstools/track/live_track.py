@@ -0,0 +1,346 @@
+import numpy as np
+
+from gpstools.track.activity_detection import DEFAULT_ACTIVITY_DETECTION_PARAMS
+from gpstools.track.normalization import DEFAULT_TRACK_NORMALIZATION_PARAMS
+from gpstools.track.speed_calculation import DEFAULT_SPEED_PARAMS, SPEED_SMOOTHING_CENTERED, get_moved_speed, \
+    smooth_speed_tail
+from gpstools.track.track import Track, TrackPointArray, TrackTimeColumn, TrackActivitySegment
+from gpstools.utils import MICROS_IN_SECOND, MICROS_IN_MINUTE, get_consecutive_dists
+
+LIVE_TRACK_INITIAL_CAPACITY = 1024
+
+# Per point buffers besides point columns
+LIVE_TRACK_BUFFER_DTYPES = {
+    'dist': np.float64,
+    'dist_from_start': np.float64,
+    'moved_speed': np.float64,  # Speed before smoothing, kph
+    'smoothed_speed': np.float64,
+    'chain_start': np.int64  # Activity segment start alignment, see get_activity_segments_for_track
+}
+
+
+class _ActivityDetectionState:
+    """State of point by point activity detection, follows the same rules as get_activity_segments_for_track"""
+
+    def __init__(self):
+        self.processed = 0
+        self.segment_start_idx = None
+        self.segment_end_idx = None
+        self.is_segment_active = False
+        self.segments = []
+
+    def copy(self):
+        state = _ActivityDetectionState()
+        state.__dict__.update(self.__dict__)
+        state.segments = list(self.segments)
+        return state
+
+
+class LiveTrack:
+    """
+    Appendable track for live position feeds. Points are appended one by one or in batches, in time order.
+    Columns are kept in buffers growing by doubling, distances, speed, stats and activity segments are updated only
+    for appended points, so appending costs O(1) amortized per point. Speed values near the end can change while
+    points arrive (centered smoothing), they are recalculated along with the new ones.
+    Normalization filters are centered and would need future points, so points are stored as they come.
+    Read API is the same as of Track, snapshot returns Track over current points for existing analysis code
+    """
+
+    def __init__(self, name, speed_params=None, activity_detection_params=DEFAULT_ACTIVITY_DETECTION_PARAMS):
+        self.name = name
+        self._speed_params = speed_params if speed_params else DEFAULT_SPEED_PARAMS
+        self.norm_params = DEFAULT_TRACK_NORMALIZATION_PARAMS
+        self.activity_detection_params = activity_detection_params
+
+        self.len = 0
+        self.tzinfo = None
+        self._capacity = LIVE_TRACK_INITIAL_CAPACITY
+        self._columns = {
+            name: np.empty(self._capacity, dtype=np.int64 if name == 'micros' else np.float64)
+            for name in TrackPointArray.COLUMNS
+        }
+        self._buffers = {
+            name: np.empty(self._capacity, dtype=dtype) for name, dtype in LIVE_TRACK_BUFFER_DTYPES.items()
+        }
+
+        self._points_without_speed = 0
+        self._points_without_bearing = 0
+        self.subsecond_precision = False
+        self._reset_speed()
+
+    def append(self, point):
+        """Appends TrackPoint"""
+        self.extend([point])
+
+    def extend(self, points):
+        """Appends list of TrackPoint or TrackPointArray"""
+        if not isinstance(points, TrackPointArray):
+            if len(points) == 0:
+                return
+            points = TrackPointArray.from_points(points)
+        if len(points) == 0:
+            return
+
+        start = self.len
+        end = start + len(points)
+        micros = self._get_track_micros(points)
+        self._reserve(end)
+
+        for name in TrackPointArray.COLUMNS:
+            self._columns[name][start:end] = micros if name == 'micros' else getattr(points, name)
+        self.len = end
+
+        # Distances are calculated with the previous point, cumulative sum continues in the same order as for Track
+        context_start = max(start - 1, 0)
+        dists = get_consecutive_dists(self._columns['lat'][context_start:end], self._columns['lon'][context_start:end])
+        self._buffers['dist'][start:end] = dists[start - context_start:]
+        previous_dist_from_start = self._buffers['dist_from_start'][context_start] if start > 0 else 0.0
+        self._buffers['dist_from_start'][start:end] = \
+            np.cumsum(np.concatenate([[previous_dist_from_start], dists[start - context_start:]]))[1:]
+
+        self._points_without_speed += int(np.count_nonzero(np.isnan(points.speed)))
+        self._points_without_bearing += int(np.count_nonzero(np.isnan(points.bearing)))
+        self.subsecond_precision = self.subsecond_precision or bool(np.any(micros % MICROS_IN_SECOND > 0))
+
+        if self._get_speed_calculation() != self._speed_calculation:
+            # Speed source or smoothing window changed, which happens at most twice for a track
+            self._reset_speed()
+        self._update_speed()
+
+    @property
+    def speed_params(self):
+        return self._speed_params
+
+    @speed_params.setter
+    def speed_params(self, speed_params):
+        self._speed_params = speed_params if speed_params else DEFAULT_SPEED_PARAMS
+        self._reset_speed()
+        self._update_speed()
+
+    @property
+    def points(self):
+        return TrackPointArray(tzinfo=self.tzinfo, **{
+            name: column[:self.len] for name, column in self._columns.items()
+        })
+
+    @property
+    def lat(self):
+        return self._columns['lat'][:self.len]
+
+    @property
+    def lon(self):
+        return self._columns['lon'][:self.len]
+
+    @property
+    def time(self):
+        return TrackTimeColumn(self._columns['micros'][:self.len], self.tzinfo)
+
+    @property
+    def dist(self):
+        return self._buffers['dist'][:self.len]
+
+    @property
+    def dist_from_start(self):
+        return self._buffers['dist_from_start'][:self.len]
+
+    @property
+    def micros_from_start(self):
+        return self._columns['micros'][:self.len] - self._columns['micros'][0]
+
+    @property
+    def speed(self):
+        """Kph for each point, calculated like Track.speed"""
+        return self._buffers['smoothed_speed'][:self.len]
+
+    @property
+    def has_bearing_data(self):
+        return self._points_without_bearing == 0
+
+    @property
+    def start_time(self):
+        return self.time[0]
+
+    @property
+    def end_time(self):
+        return self.time[self.len - 1]
+
+    @property
+    def total_time(self):
+        return self.end_time - self.start_time
+
+    @property
+    def _total_distance(self):
+        return float(self._buffers['dist_from_start'][self.len - 1])
+
+    @property
+    def avg_speed(self):
+        return self._total_distance / self.total_time.total_seconds() * 3600
+
+    @property
+    def max_speed(self):
+        changing_speed = self._buffers['smoothed_speed'][self._final_speed_len:self.len]
+        if len(changing_speed) == 0:
+            return self._final_max_speed
+        return max(self._final_max_speed, float(np.max(changing_speed)))
+
+    @property
+    def activity_segments(self):
+        """
+        Activity segments of current points including the one in progress, same as get_activity_segments_for_track
+        for a snapshot
+        """
+        # Points with changing speed are processed on a copy of the state, they will be processed again
+        state = self._activity_state.copy()
+        self._update_activity_state(state, self.len)
+
+        if state.segment_start_idx is not None:
+            end_idx = state.segment_end_idx if state.segment_end_idx is not None else self.len - 1
+            self._try_add_activity_segment(state.segments, state.segment_start_idx, end_idx)
+        return state.segments
+
+    def snapshot(self):
+        """@:returns Track over current points, points are shared and not copied"""
+        return Track.from_normalized_points(
+            self.name, self.points, self.speed_params, self.norm_params, speed=self.speed.copy()
+        )
+
+    def find_point_index(self, point_to_check, start_idx=0):
+        return self.snapshot().find_point_index(point_to_check, start_idx)
+
+    def crop_to_point_idx(self, index):
+        return self.snapshot().crop_to_point_idx(index)
+
+    def crop_from_point_idx(self, index):
+        return self.snapshot().crop_from_point_idx(index)
+
+    def crop_to_activity_segment(self, activity_segment, segment_name):
+        return self.snapshot().crop_to_activity_segment(activity_segment, segment_name)
+
+    def crop_to_activity_segment_start(self, activity_segment, segment_name):
+        return self.snapshot().crop_to_activity_segment_start(activity_segment, segment_name)
+
+    def print_stats(self):
+        Track.print_stats(self)
+
+    def print_params(self):
+        Track.print_params(self)
+
+    def _get_track_micros(self, points):
+        """Wall-clock micros of points in the track timezone, timezone is taken from the first appended points"""
+        if self.len == 0:
+            self.tzinfo = points.tzinfo
+            return points.micros
+
+        if (points.tzinfo is None) != (self.tzinfo is None):
+            raise ValueError("Cannot append points with and without timezone to the same track")
+        if points.tzinfo is None:
+            return points.micros
+
+        offset = self.tzinfo.utcoffset(None) - points.tzinfo.utcoffset(None)
+        return points.micros + (offset.days * 86400 + offset.seconds) * MICROS_IN_SECOND + offset.microseconds
+
+    def _reserve(self, size):
+        if size <= self._capacity:
+            return
+
+        self._capacity = max(self._capacity * 2, size)
+        for buffers in (self._columns, self._buffers):
+            for name, buffer in buffers.items():
+                grown = np.empty(self._capacity, dtype=buffer.dtype)
+                grown[:self.len] = buffer[:self.len]
+                buffers[name] = grown
+
+    def _get_speed_calculation(self):
+        """@:returns whether provided speed is used and smoothing window, same choice as Track makes"""
+        use_provided_speed = self.speed_params.use_provided_speed and self._points_without_speed == 0
+        if self.subsecond_precision:
+            return use_provided_speed, self.speed_params.smoothing_10hz
+        return use_provided_speed, self.speed_params.smoothing_1hz
+
+    def _reset_speed(self):
+        """Drops calculated speed and everything depending on it, it's calculated again for all points on update"""
+        self._speed_calculation = self._get_speed_calculation()
+        self._speed_len = 0
+        self._ewm_state = (0.0, 0.0)
+        self._final_speed_len = 0
+        self._final_max_speed = float('-inf')
+        self._activity_state = _ActivityDetectionState()
+
+    def _update_speed(self):
+        start, end = self._speed_len, self.len
+        if start == end:
+            return
+
+        use_provided_speed, window_size = self._speed_calculation
+        assert window_size >= 1
+        if use_provided_speed:
+            moved_speed = self._columns['speed'][start:end] * 3.6
+        else:
+            context_start = max(start - 1, 0)
+            moved_speed = get_moved_speed(
+                self._buffers['dist'][context_start:end], self._columns['micros'][context_start:end]
+            )[start - context_start:]
+        self._buffers['moved_speed'][start:end] = moved_speed
+
+        # Last points of centered windows don't have all their values yet, they are recalculated later
+        lead = window_size // 2 if self.speed_params.smoothing_mode == SPEED_SMOOTHING_CENTERED else 0
+        tail_start = max(start - lead, 0)
+        smoothed, self._ewm_state = smooth_speed_tail(
+            self._buffers['moved_speed'][:end], tail_start, window_size, self.speed_params.smoothing_mode,
+            self._ewm_state
+        )
+        self._buffers['smoothed_speed'][tail_start:end] = smoothed
+        self._speed_len = end
+
+        final_speed_len = max(end - lead, 0)
+        if final_speed_len > self._final_speed_len:
+            self._final_max_speed = max(
+                self._final_max_speed,
+                float(np.max(self._buffers['smoothed_speed'][self._final_speed_len:final_speed_len]))
+            )
+            self._final_speed_len = final_speed_len
+            self._update_activity_state(self._activity_state, final_speed_len)
+
+    def _update_activity_state(self, state, end):
+        """Processes points [state.processed, end), see get_activity_segments_for_track for the rules"""
+        params = self.activity_detection_params
+        speed = self._buffers['smoothed_speed']
+        micros = self._columns['micros']
+        chain_starts = self._buffers['chain_start']
+
+        for i in range(state.processed, end):
+            if i == 0:
+                chain_starts[i] = 0
+            elif params.align_to_minutes:
+                is_chain_continued = micros[i - 1] // MICROS_IN_MINUTE % 60 == micros[i] // MICROS_IN_MINUTE % 60
+                chain_starts[i] = chain_starts[i - 1] if is_chain_continued else i
+            else:
+                chain_starts[i] = chain_starts[i - 1] if 0 < speed[i - 1] < speed[i] else i
+
+            if state.segment_start_idx is None:
+                state.segment_start_idx = i
+                state.segment_end_idx = None
+                state.is_segment_active = False
+            elif speed[i] < params.speed_eps:
+                if not state.is_segment_active:
+                    state.segment_start_idx = i
+                elif state.segment_end_idx is None:
+                    state.segment_end_idx = i
+                elif (micros[i] - micros[state.segment_end_idx]) / MICROS_IN_SECOND > params.segment_max_allow_pause:
+                    self._try_add_activity_segment(state.segments, state.segment_start_idx, state.segment_end_idx)
+                    state.segment_start_idx = None
+                    state.segment_end_idx = None
+                    state.is_segment_active = False
+            else:
+                state.is_segment_active = True
+                state.segment_end_idx = None
+                state.segment_start_idx = int(chain_starts[state.segment_start_idx])
+
+        state.processed = max(state.processed, end)
+
+    def _try_add_activity_segment(self, segments, start_idx, end_idx):
+        micros = self._columns['micros']
+        duration = (micros[end_idx] - micros[start_idx]) / MICROS_IN_SECOND
+        if duration >= self.activity_detection_params.segment_min_duration:
+            points = self.points
+            segments.append(TrackActivitySegment(len(segments), start_idx, end_idx, points[start_idx], points[end_idx]))
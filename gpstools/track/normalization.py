@@ -1,47 +1,77 @@
 from collections import namedtuple
 
-TrackNormalizationParams = namedtuple('TrackNormalizationParams', ['align_to_minutes', 'neighbor_weights'])
+import numpy as np
+
+from gpstools.utils import MICROS_IN_MINUTE
+
+# neighbor_weights - FIR kernel of odd length centered at the point (i.e. [0.25, 0.5, 0.25])
+# savgol_window, savgol_order - Savitzky-Golay filter window (odd number of points) and polynomial order
+# filtered_columns - TrackPointArray columns smoothed by filters, 'speed' can be added to smooth provided speed
+# Filters are applied in the order above, column edges are extended with edge values
+TrackNormalizationParams = namedtuple(
+    'TrackNormalizationParams',
+    ['align_to_minutes', 'neighbor_weights', 'savgol_window', 'savgol_order', 'filtered_columns'],
+    defaults=[None, 2, ('lat', 'lon', 'altitude')]
+)
 
 DEFAULT_TRACK_NORMALIZATION_PARAMS = TrackNormalizationParams(align_to_minutes=False, neighbor_weights=None)
 
 
 def normalize_minute_starts(points):
-    from gpstools.track.track import TrackPoint
-    if len(points) > 0 and (points[0].time.second != 0 or points[0].time.microsecond > 0):
-        new_time = points[0].time.replace(second=0, microsecond=0)
-        start_point = TrackPoint(
-            new_time,
-            points[0].lat,
-            points[0].lon,
-            points[0].altitude,
-            points[0].speed,
-            points[0].bearing
-        )
-        points.insert(0, start_point)
+    """Adds a copy of the first point aligned to the minute start, points are TrackPointArray"""
+    from gpstools.track.track import TrackPointArray
+    if len(points) > 0 and points.micros[0] % MICROS_IN_MINUTE > 0:
+        start_point = points[:1].copy()
+        start_point.micros[0] -= start_point.micros[0] % MICROS_IN_MINUTE
+        return TrackPointArray.concatenate([start_point, points])
 
     return points
 
 
+def normalize_by_filters(points, norm_params):
+    """Applies filters selected in norm_params to filtered columns, points are TrackPointArray"""
+    kernels = []
+    if norm_params.neighbor_weights:
+        kernels.append(norm_params.neighbor_weights)
+    if norm_params.savgol_window:
+        kernels.append(get_savgol_kernel(norm_params.savgol_window, norm_params.savgol_order))
+
+    if len(kernels) == 0:
+        return points
+
+    columns = {}
+    for name in norm_params.filtered_columns:
+        column = getattr(points, name)
+        for kernel in kernels:
+            column = apply_kernel(column, kernel)
+        columns[name] = column
+
+    return points.with_columns(**columns)
+
+
 def normalize_by_neighbor_weights(points, neighbor_weights):
-    from gpstools.track.track import TrackPoint
-    new_points = []
-
-    prev_point = points[0]
-    for i, point in enumerate(points):
-        next_point = points[i + 1] if i < len(points) - 1 else points[i]
-
-        new_points.append(TrackPoint(
-            time=point.time,
-            lat=neighbor_weights[0] * prev_point.lat +
-                     neighbor_weights[1] * point.lat + neighbor_weights[2] * next_point.lat,
-            lon=neighbor_weights[0] * prev_point.lon +
-                     neighbor_weights[1] * point.lon + neighbor_weights[2] * next_point.lon,
-            altitude=neighbor_weights[0] * prev_point.altitude +
-                     neighbor_weights[1] * point.altitude + neighbor_weights[2] * next_point.altitude,
-            speed=point.speed,
-            bearing=point.bearing
-        ))
-
-        prev_point = point
-
-    return new_points
+    return normalize_by_filters(points, DEFAULT_TRACK_NORMALIZATION_PARAMS._replace(neighbor_weights=neighbor_weights))
+
+
+def apply_kernel(column, kernel):
+    """
+    Convolution with centered kernel of odd length, column edges are extended with edge values.
+    Padded column is convolved in a single call, so wide kernels don't add python loop steps
+    """
+    if len(kernel) % 2 != 1:
+        raise ValueError("Filter kernel should have odd length, got %d" % len(kernel))
+
+    half_size = len(kernel) // 2
+    padded = np.pad(column, half_size, mode='edge')
+
+    return np.convolve(padded, np.asarray(kernel, dtype=np.float64)[::-1], 'valid')
+
+
+def get_savgol_kernel(window, order):
+    """Savitzky-Golay smoothing coefficients: least squares polynomial fit of the window evaluated at its center"""
+    if window % 2 != 1 or window <= order:
+        raise ValueError("Savitzky-Golay window should be odd and larger than order, got %d and %d" % (window, order))
+
+    half_size = window // 2
+    vandermonde = np.vander(np.arange(-half_size, half_size + 1), order + 1, increasing=True)
+    return np.linalg.pinv(vandermonde)[0]
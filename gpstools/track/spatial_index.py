@@ -0,0 +1,178 @@
+from copy import copy
+from math import cos, radians
+
+import numpy as np
+
+from gpstools.utils import EARTH_RADIUS, get_dists
+
+SPATIAL_INDEX_CELL_SIZE_KM = 0.05
+
+# Extra scale of search radius on top of projection distortion, covers earth curvature on track scales
+SPATIAL_INDEX_RADIUS_MARGIN = 1.01
+
+
+class TrackSpatialIndex:
+    """
+    Grid index over track points in local equirectangular projection. Grid is used only to select candidates,
+    search radius is scaled by projection distortion, and candidates are checked with haversine distance,
+    so results are the same as of full scan.
+    Queries can be limited to [start_idx, end_idx) points, restricted index returns indices relative to start_idx
+    """
+
+    def __init__(self, lat, lon, cell_size_km=SPATIAL_INDEX_CELL_SIZE_KM):
+        assert len(lat) > 0
+        self.lat = lat
+        self.lon = lon
+        self.cell_size_km = cell_size_km
+        self._start = 0
+        self._end = len(lat)
+
+        lat_min, lat_max = float(np.min(lat)), float(np.max(lat))
+        self._lat0 = (lat_min + lat_max) / 2
+        self._lon0 = (float(np.min(lon)) + float(np.max(lon))) / 2
+        self._cos_lat0 = cos(radians(self._lat0))
+        self._min_cos_lat = min(cos(radians(lat_min)), cos(radians(lat_max)))
+
+        cell_x, cell_y = self._get_cells(lat, lon)
+        self._cell_x_min, self._cell_x_max = int(np.min(cell_x)), int(np.max(cell_x))
+        self._cell_y_min, self._cell_y_max = int(np.min(cell_y)), int(np.max(cell_y))
+
+        # Point indices sorted by cell, indices within a cell stay ascending, so the first and the last index of a cell
+        # tell whether any of its points are in the query range
+        keys = self._get_cell_keys(cell_x, cell_y)
+        self._order = np.argsort(keys, kind='stable')
+        self._cell_keys, self._cell_starts = np.unique(keys[self._order], return_index=True)
+        self._cell_ends = np.append(self._cell_starts[1:], len(keys))
+        self._cell_first_idx = self._order[self._cell_starts]
+        self._cell_last_idx = self._order[self._cell_ends - 1]
+
+    def restricted(self, start_idx, end_idx):
+        """@:returns index sharing the grid with queries limited to [start_idx, end_idx) points of this index"""
+        index = copy(self)
+        index._start = self._start + start_idx
+        index._end = min(self._start + end_idx, self._end)
+        return index
+
+    def nearest(self, lat, lon, start_idx=0):
+        """@:returns tuple of the nearest point index after start_idx and distance to it (km), lowest index on ties"""
+        if self._start + start_idx >= self._end:
+            return None, None
+
+        cell_x, cell_y = self._get_cell(lat, lon)
+        max_ring = self._get_max_ring(cell_x, cell_y)
+
+        # Expanding rings until any point is found, then checking all cells which can contain closer points
+        ring = 0
+        candidates = self._get_candidates(cell_x, cell_y, 0, 0, start_idx)
+        while len(candidates) == 0 and ring < max_ring:
+            ring += 1
+            candidates = self._get_candidates(cell_x, cell_y, ring, ring, start_idx)
+        if len(candidates) == 0:
+            return None, None
+
+        dists = get_dists(lat, lon, self.lat[candidates], self.lon[candidates])
+        search_radius = float(np.min(dists)) * self._get_radius_scale(lat)
+        last_ring = min(int(search_radius / self.cell_size_km) + 1, max_ring)
+        if last_ring > ring:
+            candidates = np.concatenate([
+                candidates, self._get_candidates(cell_x, cell_y, ring + 1, last_ring, start_idx)
+            ])
+            dists = get_dists(lat, lon, self.lat[candidates], self.lon[candidates])
+
+        best = np.flatnonzero(dists == np.min(dists))
+        best_idx = int(np.min(candidates[best]))
+        return best_idx - self._start, float(np.min(dists))
+
+    def within_radius(self, lat, lon, radius_km, start_idx=0):
+        """@:returns ascending indices of points after start_idx closer than radius_km"""
+        cell_x, cell_y = self._get_cell(lat, lon)
+        last_ring = min(int(radius_km * self._get_radius_scale(lat) / self.cell_size_km) + 1,
+                        self._get_max_ring(cell_x, cell_y))
+
+        candidates = self._get_candidates(cell_x, cell_y, 0, last_ring, start_idx)
+        dists = get_dists(lat, lon, self.lat[candidates], self.lon[candidates])
+        return np.sort(candidates[dists < radius_km]) - self._start
+
+    def first_within(self, lat, lon, radius_km, start_idx=0):
+        """@:returns index of the first point after start_idx closer than radius_km or None"""
+        indices = self.within_radius(lat, lon, radius_km, start_idx)
+        return int(indices[0]) if len(indices) > 0 else None
+
+    def nearest_many(self, lats, lons, start_idx=0):
+        """@:returns arrays of nearest point indices and distances for each of given points"""
+        results = [self.nearest(lat, lon, start_idx) for lat, lon in zip(np.asarray(lats).tolist(),
+                                                                         np.asarray(lons).tolist())]
+        return np.array([r[0] for r in results]), np.array([r[1] for r in results])
+
+    def first_within_many(self, lats, lons, radius_km, start_idx=0):
+        """@:returns list of first point indices (or None) for each of given points"""
+        return [
+            self.first_within(lat, lon, radius_km, start_idx)
+            for lat, lon in zip(np.asarray(lats).tolist(), np.asarray(lons).tolist())
+        ]
+
+    def _get_radius_scale(self, lat):
+        """Projected distances are longer than real ones at most by this scale for points within the grid latitudes"""
+        return SPATIAL_INDEX_RADIUS_MARGIN * self._cos_lat0 / min(self._min_cos_lat, cos(radians(lat)))
+
+    def _get_cells(self, lat, lon):
+        x = EARTH_RADIUS * self._cos_lat0 * np.radians(lon - self._lon0)
+        y = EARTH_RADIUS * np.radians(lat - self._lat0)
+        return np.floor(x / self.cell_size_km).astype(np.int64), np.floor(y / self.cell_size_km).astype(np.int64)
+
+    def _get_cell(self, lat, lon):
+        cell_x, cell_y = self._get_cells(np.array([lat]), np.array([lon]))
+        return int(cell_x[0]), int(cell_y[0])
+
+    def _get_cell_keys(self, cell_x, cell_y):
+        return (cell_x - self._cell_x_min) * (self._cell_y_max - self._cell_y_min + 1) + (cell_y - self._cell_y_min)
+
+    def _get_max_ring(self, cell_x, cell_y):
+        """Ring around the cell which covers the whole grid"""
+        return max(
+            abs(cell_x - self._cell_x_min), abs(cell_x - self._cell_x_max),
+            abs(cell_y - self._cell_y_min), abs(cell_y - self._cell_y_max)
+        )
+
+    def _get_candidates(self, cell_x, cell_y, first_ring, last_ring, start_idx):
+        """@:returns indices of points in cells of given rings around the cell, limited to the query range"""
+        ring_cells = [self._get_ring_cells(cell_x, cell_y, ring) for ring in range(first_ring, last_ring + 1)]
+        if len(ring_cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        keys = self._get_cell_keys(
+            np.concatenate([x for x, _ in ring_cells]), np.concatenate([y for _, y in ring_cells])
+        )
+        cells = np.minimum(np.searchsorted(self._cell_keys, keys), len(self._cell_keys) - 1)
+        cells = cells[self._cell_keys[cells] == keys]
+
+        # Cells with all points out of the query range are skipped without collecting their points
+        in_range = (self._cell_last_idx[cells] >= self._start + start_idx) & (self._cell_first_idx[cells] < self._end)
+        cells = cells[in_range]
+        if len(cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Concatenated ranges of sorted points of the cells
+        starts = self._cell_starts[cells]
+        sizes = self._cell_ends[cells] - starts
+        range_offsets = np.cumsum(sizes) - sizes
+        candidates = self._order[np.repeat(starts - range_offsets, sizes) + np.arange(int(np.sum(sizes)))]
+        return candidates[(candidates >= self._start + start_idx) & (candidates < self._end)]
+
+    def _get_ring_cells(self, cell_x, cell_y, ring):
+        """Arrays of x and y of cells at Chebyshev distance ring from the cell, clipped to the grid"""
+        if ring == 0:
+            if self._cell_x_min <= cell_x <= self._cell_x_max and self._cell_y_min <= cell_y <= self._cell_y_max:
+                return np.array([cell_x]), np.array([cell_y])
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        xs = np.arange(max(cell_x - ring, self._cell_x_min), min(cell_x + ring, self._cell_x_max) + 1)
+        ys = np.arange(max(cell_y - ring + 1, self._cell_y_min), min(cell_y + ring - 1, self._cell_y_max) + 1)
+
+        rows = [y for y in (cell_y - ring, cell_y + ring) if self._cell_y_min <= y <= self._cell_y_max]
+        columns = [x for x in (cell_x - ring, cell_x + ring) if self._cell_x_min <= x <= self._cell_x_max]
+        empty = np.zeros(0, dtype=np.int64)
+        return (
+            np.concatenate([empty] + [xs] * len(rows) + [np.full(len(ys), x) for x in columns]).astype(np.int64),
+            np.concatenate([empty] + [np.full(len(xs), y) for y in rows] + [ys] * len(columns)).astype(np.int64)
+        )
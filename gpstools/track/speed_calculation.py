@@ -1,60 +1,140 @@
 from collections import namedtuple
-from collections import deque
-from gpstools.utils import avg, get_timedelta_micros, get_dist
+from math import log
 
-TrackSpeedParams = namedtuple('TrackSpeedParams', ['use_provided_speed', 'smoothing_1hz', 'smoothing_10hz'])
-
-DEFAULT_SPEED_PARAMS = TrackSpeedParams(use_provided_speed=True, smoothing_1hz=1, smoothing_10hz=3)
+import numpy as np
 
+from gpstools.utils import get_consecutive_dists
 
-def calculate_speed_with_provided_data(points, window_size):
-    """Uses built-in gps speed data and converts it to kph units"""
-    assert window_size >= 1
-    speed_window = deque()
-    speed = []
+# Smoothing window modes: trailing - window ends at the point, centered - window is centered at the point,
+# ewm - exponentially weighted mean with span equal to window size
+SPEED_SMOOTHING_TRAILING = 'trailing'
+SPEED_SMOOTHING_CENTERED = 'centered'
+SPEED_SMOOTHING_EWM = 'ewm'
+SPEED_SMOOTHING_MODES = [SPEED_SMOOTHING_TRAILING, SPEED_SMOOTHING_CENTERED, SPEED_SMOOTHING_EWM]
 
-    for i in range(len(points)):
-        cur_point = points[i]
-        speed_window.append(cur_point.speed * 3.6)
+TrackSpeedParams = namedtuple('TrackSpeedParams',
+                              ['use_provided_speed', 'smoothing_1hz', 'smoothing_10hz', 'smoothing_mode'],
+                              defaults=[SPEED_SMOOTHING_TRAILING])
 
-        if len(speed_window) > window_size:
-            speed_window.popleft()
+DEFAULT_SPEED_PARAMS = TrackSpeedParams(use_provided_speed=True, smoothing_1hz=1, smoothing_10hz=3)
 
-        speed_window_without_zeros = list(filter(lambda x: x != 0.0, speed_window))
-        if len(speed_window_without_zeros) == 0:
-            speed.append(0)
-        else:
-            speed.append(avg(speed_window_without_zeros))
+# Windows up to this size are summed value by value, in the same order as python sum does. Larger windows use
+# running sums, so their cost doesn't depend on window size
+ROLLING_SUM_EXACT_MAX_WINDOW = 16
 
-    return speed
+# Limit for decay powers used in blocks of exponentially weighted sums
+EWM_MAX_DECAY_POWER = 1e150
 
 
-# Method based on inaccurate data, used when no speed data available in track
-def calculate_speed_by_distance(points, window_size):
+def calculate_speed_with_provided_data(points, window_size, mode=SPEED_SMOOTHING_TRAILING):
+    """Uses built-in gps speed data and converts it to kph units, points are TrackPointArray or list of TrackPoint"""
     assert window_size >= 1
-    speed_window = deque()
-    speed = []
-
-    prev_point = points[0]
-    for i in range(len(points)):
-        cur_point = points[i]
-        time_delta_micros = get_timedelta_micros(cur_point.time, prev_point.time)
-        if time_delta_micros == 0:
-            cur_speed = 0
-        else:
-            cur_speed = get_dist(cur_point, prev_point) / time_delta_micros * 1000000 * 3600
+    points = _as_point_array(points)
+    return smooth_speed(points.speed * 3.6, window_size, mode)
 
-        speed_window.append(cur_speed)
 
-        if len(speed_window) > window_size:
-            speed_window.popleft()
-
-        speed_window_without_zeros = list(filter(lambda x: x != 0.0, speed_window))
-        if len(speed_window_without_zeros) == 0:
-            speed.append(0)
-        else:
-            speed.append(avg(speed_window_without_zeros))
-
-        prev_point = cur_point
-
-    return speed
+# Method based on inaccurate data, used when no speed data available in track
+def calculate_speed_by_distance(points, window_size, mode=SPEED_SMOOTHING_TRAILING):
+    """Kph by distances between points, points are TrackPointArray or list of TrackPoint"""
+    assert window_size >= 1
+    points = _as_point_array(points)
+
+    moved_speed = get_moved_speed(get_consecutive_dists(points.lat, points.lon), points.micros)
+    return smooth_speed(moved_speed, window_size, mode)
+
+
+def _as_point_array(points):
+    from gpstools.track.track import TrackPointArray
+    if isinstance(points, TrackPointArray):
+        return points
+    return TrackPointArray.from_points(points)
+
+
+def get_moved_speed(dists, micros):
+    """Kph by distance (km) and time since the previous point, zero for the first point and points without time delta"""
+    time_deltas_micros = np.diff(micros, prepend=micros[0])
+    moved_speed = np.zeros(len(micros))
+    has_time_delta = time_deltas_micros != 0
+    moved_speed[has_time_delta] = dists[has_time_delta] / time_deltas_micros[has_time_delta] * 1000000 * 3600
+    return moved_speed
+
+
+def smooth_speed(speed, window_size, mode=SPEED_SMOOTHING_TRAILING):
+    """
+    Rolling mean of speed which skips zero values (GPS drops), points without non-zero values in the window get zero
+    speed. Trailing mode gives exactly the same values as averaging the filtered window point by point
+    """
+    smoothed, _ = smooth_speed_tail(speed, 0, window_size, mode)
+    return smoothed
+
+
+def smooth_speed_tail(speed, tail_start, window_size, mode=SPEED_SMOOTHING_TRAILING, ewm_state=(0.0, 0.0)):
+    """
+    Smoothed speed[tail_start:], same values as of smooth_speed for the whole array. Rolling windows take values
+    before tail_start, ewm mode continues from ewm_state - weighted sums of speed and of non-zero flags at the point
+    before tail_start, so points appended to a track can be smoothed without recalculating the whole track
+    @:returns smoothed tail and ewm state at its last point
+    """
+    if mode not in SPEED_SMOOTHING_MODES:
+        raise ValueError("Unknown speed smoothing mode %s" % mode)
+
+    lead = window_size // 2 if mode == SPEED_SMOOTHING_CENTERED else 0
+    context_start = max(tail_start - (window_size - 1 - lead), 0)
+    tail_offset = tail_start - context_start
+    is_moving = (speed[context_start:] != 0.0).astype(np.int64)
+
+    counts = _rolling_sum(is_moving, window_size, lead)[tail_offset:]
+    if mode == SPEED_SMOOTHING_EWM:
+        alpha = 2.0 / (window_size + 1)
+        sums = _exponential_moving_sum(speed[tail_start:], alpha, ewm_state[0])
+        counts_or_weights = _exponential_moving_sum(is_moving[tail_offset:].astype(np.float64), alpha, ewm_state[1])
+        if len(sums) > 0:
+            ewm_state = (float(sums[-1]), float(counts_or_weights[-1]))
+    else:
+        sums = _rolling_sum(speed[context_start:], window_size, lead)[tail_offset:]
+        counts_or_weights = counts
+
+    smoothed = np.zeros(len(counts))
+    np.divide(sums, counts_or_weights, out=smoothed, where=counts > 0)
+    return smoothed, ewm_state
+
+
+def _rolling_sum(values, window_size, lead):
+    """Sums of windows [i - window_size + 1 + lead, i + lead], values outside of the array count as zeros"""
+    n = len(values)
+    padded = np.concatenate([
+        np.zeros(window_size - 1 - lead, dtype=values.dtype), values, np.zeros(lead, dtype=values.dtype)
+    ])
+
+    if window_size <= ROLLING_SUM_EXACT_MAX_WINDOW:
+        sums = np.zeros(n, dtype=values.dtype)
+        for k in range(window_size):
+            sums += padded[k:k + n]
+        return sums
+
+    cumulative = np.concatenate([np.zeros(1, dtype=values.dtype), np.cumsum(padded)])
+    return cumulative[window_size:window_size + n] - cumulative[:n]
+
+
+def _exponential_moving_sum(values, alpha, initial_sum=0.0):
+    """
+    s[i] = (1 - alpha) * s[i - 1] + alpha * values[i], s[-1] is initial_sum. Calculated with cumulative sums in blocks,
+    block size keeps decay powers in float range
+    """
+    decay = 1.0 - alpha
+    if decay == 0.0:
+        return values.astype(np.float64)
+
+    block_size = max(1, int(log(EWM_MAX_DECAY_POWER) / -log(decay)))
+    powers = decay ** np.arange(min(block_size, len(values)))
+
+    sums = np.empty(len(values))
+    state = initial_sum
+    for start in range(0, len(values), block_size):
+        block = values[start:start + block_size]
+        block_powers = powers[:len(block)]
+        sums[start:start + len(block)] = \
+            decay * block_powers * state + alpha * block_powers * np.cumsum(block / block_powers)
+        state = sums[start + len(block) - 1]
+
+    return sums
@@ -1,10 +1,16 @@
 import datetime
+from copy import copy
 from datetime import datetime
 
+import numpy as np
+
 from gpstools.config import POINT_DISTANCE_THRESHOLD_KM
+from gpstools.track.spatial_index import TrackSpatialIndex
 from gpstools.track.speed_calculation import *
 from gpstools.track.normalization import DEFAULT_TRACK_NORMALIZATION_PARAMS, normalize_minute_starts, \
-    normalize_by_neighbor_weights
+    normalize_by_filters
+from gpstools.utils import get_fixed_tzinfo, datetime_to_micros, micros_to_datetime, get_consecutive_dists, \
+    lazy_property, invalidate_lazy_properties
 
 
 class Coords:
@@ -53,86 +59,249 @@ class TrackPoint:
         return Coords(self.lat, self.lon)
 
 
+def _optional_float(value):
+    """Missing values are stored as NaN in columns and exposed as None in points"""
+    return None if np.isnan(value) else float(value)
+
+
+class TrackTimeColumn:
+    """Read-only sequence of datetimes backed by wall-clock microseconds array"""
+
+    def __init__(self, micros, tzinfo):
+        self.micros = micros
+        self.tzinfo = tzinfo
+
+    def __len__(self):
+        return len(self.micros)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return TrackTimeColumn(self.micros[key], self.tzinfo)
+        return micros_to_datetime(self.micros[key], self.tzinfo)
+
+    def __iter__(self):
+        for micros in self.micros.tolist():
+            yield micros_to_datetime(micros, self.tzinfo)
+
+
+class TrackPointArray:
+    """
+    Columnar storage of track points. Each field is a contiguous numpy array:
+    micros - int64 wall-clock microseconds since epoch in track timezone (tzinfo, None for naive timestamps)
+    lat, lon, altitude - float64
+    speed - float64 (m/s), NaN when missing
+    bearing - float64 (degrees), NaN when missing
+    Indexing returns TrackPoint built on the fly, slicing returns array over views of the same columns,
+    indexing with an array of indices returns array with copied columns
+    """
+
+    COLUMNS = ['micros', 'lat', 'lon', 'altitude', 'speed', 'bearing']
+
+    def __init__(self, micros, lat, lon, altitude, speed, bearing, tzinfo=None):
+        self.micros = np.asarray(micros, dtype=np.int64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.altitude = np.asarray(altitude, dtype=np.float64)
+        self.speed = np.asarray(speed, dtype=np.float64)
+        self.bearing = np.asarray(bearing, dtype=np.float64)
+        self.tzinfo = tzinfo
+
+    @staticmethod
+    def from_points(points):
+        tzinfo = get_fixed_tzinfo(points[0].time) if len(points) > 0 else None
+        return TrackPointArray(
+            micros=[datetime_to_micros(p.time, tzinfo) for p in points],
+            lat=[p.lat for p in points],
+            lon=[p.lon for p in points],
+            altitude=[np.nan if p.altitude is None else p.altitude for p in points],
+            speed=[np.nan if p.speed is None else p.speed for p in points],
+            bearing=[np.nan if p.bearing is None else p.bearing for p in points],
+            tzinfo=tzinfo
+        )
+
+    @staticmethod
+    def concatenate(arrays):
+        columns = {name: np.concatenate([getattr(a, name) for a in arrays]) for name in TrackPointArray.COLUMNS}
+        return TrackPointArray(tzinfo=arrays[0].tzinfo, **columns)
+
+    @property
+    def time(self):
+        return TrackTimeColumn(self.micros, self.tzinfo)
+
+    def with_columns(self, **columns):
+        """Returns array sharing all columns except given ones"""
+        values = {name: getattr(self, name) for name in TrackPointArray.COLUMNS}
+        values.update(columns)
+        return TrackPointArray(tzinfo=self.tzinfo, **values)
+
+    def copy(self):
+        return TrackPointArray(tzinfo=self.tzinfo, **{
+            name: getattr(self, name).copy() for name in TrackPointArray.COLUMNS
+        })
+
+    def __len__(self):
+        return len(self.micros)
+
+    def __getitem__(self, key):
+        if isinstance(key, (slice, list, np.ndarray)):
+            return TrackPointArray(tzinfo=self.tzinfo, **{
+                name: getattr(self, name)[key] for name in TrackPointArray.COLUMNS
+            })
+
+        return TrackPoint(
+            time=micros_to_datetime(self.micros[key], self.tzinfo),
+            lat=float(self.lat[key]),
+            lon=float(self.lon[key]),
+            altitude=_optional_float(self.altitude[key]),
+            speed=_optional_float(self.speed[key]),
+            bearing=_optional_float(self.bearing[key])
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class Track:
+    """
+    Track over columnar point storage. Points can be given either as TrackPointArray or as a list of TrackPoint.
+    lat, lon, dist, dist_from_start, micros_from_start and speed are numpy arrays, points and time are sequence views.
+    Derived arrays and stats are calculated on first access and cached, changing speed_params drops only cached values
+    depending on speed. Cropped tracks are views over arrays of the track they were cropped from (root track),
+    distances and times from start are rebased on first access
+    """
+
+    # Cached values which are recalculated when speed params change
+    SPEED_PROPERTIES = ['speed', 'max_speed']
 
     def __init__(self, name, points, speed_params, norm_params):
         self.name = name
-        self.speed_params = speed_params if speed_params else DEFAULT_SPEED_PARAMS
+        self._speed_params = speed_params if speed_params else DEFAULT_SPEED_PARAMS
         self.norm_params = norm_params if norm_params else DEFAULT_TRACK_NORMALIZATION_PARAMS
 
-        self.points = self._normalize_points(points)
-
-        self.len = len(points)
+        if not isinstance(points, TrackPointArray):
+            points = TrackPointArray.from_points(points)
         assert len(points) > 0
 
-        # Initializes len, lat, dist, dist_from_start, micros_from_start and other arrays
-        self._init_point_stat_arrays()
-
-        self.subsecond_precision = self._has_subsecond_precision()
-        self.has_bearing_data = self._has_bearing_data()
-        self.speed = self._calculate_speed()  # Kph
+        self._init_points(self._normalize_points(points))
 
-        self._init_stats()
-
-    def _has_speed_data(self):
+    @staticmethod
+    def from_normalized_points(name, points, speed_params, norm_params, speed=None):
         """
-        Some tracks do not have exact speed data present in track,
-        so we need to fall back to inaccurate speed calculation methods
+        Builds track over points which were already normalized with given norm_params (i.e. loaded from cache).
+        Speed (kph) is calculated when it's not provided
         """
-        speed_data_available = True
-        for point in self.points:
-            if point.speed is None:
-                print('Point without speed %s!' % str(point))
-                speed_data_available = False
-
-        return speed_data_available
+        track = Track.__new__(Track)
+        track.name = name
+        track._speed_params = speed_params if speed_params else DEFAULT_SPEED_PARAMS
+        track.norm_params = norm_params if norm_params else DEFAULT_TRACK_NORMALIZATION_PARAMS
+        track._init_points(points)
+        if speed is not None:
+            track.__dict__['speed'] = speed
+        return track
+
+    def _init_points(self, points, crop_root=None, crop_start=0):
+        """Cropped tracks are initialized with [crop_start, crop_start + len(points)) points of the root track"""
+        assert len(points) > 0
+        self.points = points
+        self.len = len(points)
+        self.lat = points.lat
+        self.lon = points.lon
+        self.time = points.time
+        self._crop_root = crop_root
+        self._crop_start = crop_start
+
+    @property
+    def speed_params(self):
+        return self._speed_params
+
+    @speed_params.setter
+    def speed_params(self, speed_params):
+        self._speed_params = speed_params if speed_params else DEFAULT_SPEED_PARAMS
+        invalidate_lazy_properties(self, Track.SPEED_PROPERTIES)
+
+    def with_speed_params(self, speed_params):
+        """Returns copy of the track sharing points and all cached values which don't depend on speed"""
+        track = copy(self)
+        track.speed_params = speed_params
+        return track
+
+    @lazy_property
+    def dist(self):
+        if self._crop_root is None:
+            return get_consecutive_dists(self.lat, self.lon)
+
+        root_dist = self._crop_root.dist[self._crop_start:self._crop_start + self.len]
+        return np.concatenate([[0.0], root_dist[1:]])
+
+    @lazy_property
+    def dist_from_start(self):
+        if self._crop_root is None:
+            return np.cumsum(self.dist)
+
+        root_dist_from_start = self._crop_root.dist_from_start[self._crop_start:self._crop_start + self.len]
+        return root_dist_from_start - root_dist_from_start[0]
+
+    @lazy_property
+    def micros_from_start(self):
+        return self.points.micros - self.points.micros[0]
+
+    @lazy_property
+    def subsecond_precision(self):
+        # Speed of cropped tracks is taken from the root track, so precision is shared too
+        if self._crop_root is not None:
+            return self._crop_root.subsecond_precision
+        return bool(np.any(self.points.micros % 1000000 > 0))
+
+    @lazy_property
+    def has_bearing_data(self):
+        return not np.any(np.isnan(self.points.bearing))
+
+    @lazy_property
+    def speed(self):
+        """Kph for each point, cropped tracks reuse speed of the root track when it has the same speed params"""
+        if self._crop_root is not None and self._crop_root.speed_params == self.speed_params:
+            return self._crop_root.speed[self._crop_start:self._crop_start + self.len]
+        return self._calculate_speed()
+
+    @lazy_property
+    def start_time(self):
+        return self.time[0]
+
+    @lazy_property
+    def end_time(self):
+        return self.time[self.len - 1]
+
+    @lazy_property
+    def total_time(self):
+        return self.end_time - self.start_time
+
+    @lazy_property
+    def _total_distance(self):
+        if self._crop_root is None:
+            return float(self.dist_from_start[-1])
+
+        root_dist_from_start = self._crop_root.dist_from_start
+        return float(root_dist_from_start[self._crop_start + self.len - 1] - root_dist_from_start[self._crop_start])
+
+    @lazy_property
+    def avg_speed(self):
+        return self._total_distance / self.total_time.total_seconds() * 3600
+
+    @lazy_property
+    def max_speed(self):
+        return float(np.max(self.speed))
 
-    def _has_bearing_data(self):
+    def _has_speed_data(self):
         """
         Some tracks do not have exact speed data present in track,
         so we need to fall back to inaccurate speed calculation methods
         """
-        bearing_data_available = True
-        for point in self.points:
-            if point.bearing is None:
-                bearing_data_available = False
-
-        return bearing_data_available
-
-    def _has_subsecond_precision(self):
-        for i in range(self.len):
-            if self.points[i].time.microsecond > 0:
-                return True
-
-    def _init_point_stat_arrays(self):
-        self.lat = []
-        self.lon = []
-        self.time = []
-        self.dist = []
-        self.dist_from_start = []
-        self.micros_from_start = []
-
-        prev_point = self.points[0]
-        start_time = self.points[0].time
-        dist_from_start = 0.0
-
-        for i in range(self.len):
-            cur_point = self.points[i]
-            self.lat.append(cur_point.lat)
-            self.lon.append(cur_point.lon)
-            self.time.append(cur_point.time)
-            self.micros_from_start.append(get_timedelta_micros(cur_point.time, start_time))
-
-            if i == 0:
-                point_dist = 0.0
-            else:
-                point_dist = get_dist(cur_point, prev_point)
-
-            dist_from_start += point_dist
-            self.dist_from_start.append(dist_from_start)
-            self.dist.append(point_dist)
-
-            prev_point = cur_point
+        points_without_speed = np.count_nonzero(np.isnan(self.points.speed))
+        if points_without_speed > 0:
+            print('%d points without speed!' % points_without_speed)
+
+        return points_without_speed == 0
 
     def _calculate_speed(self):
         """Returns array of speed in kph for each point in given track"""
@@ -143,10 +312,10 @@ class Track:
 
         if self.speed_params.use_provided_speed and self._has_speed_data():
             print('Using built-in speed')
-            return calculate_speed_with_provided_data(self.points, smoothing_window)
+            return calculate_speed_with_provided_data(self.points, smoothing_window, self.speed_params.smoothing_mode)
         else:
             print('Calculating speed based on distance')
-            return calculate_speed_by_distance(self.points, smoothing_window)
+            return calculate_speed_by_distance(self.points, smoothing_window, self.speed_params.smoothing_mode)
 
     def _normalize_points(self, points):
         if self.norm_params.align_to_minutes:
@@ -154,20 +323,7 @@ class Track:
         else:
             normalized_by_minutes = points
 
-        if self.norm_params.neighbor_weights:
-            return normalize_by_neighbor_weights(normalized_by_minutes, self.norm_params.neighbor_weights)
-        else:
-            return normalized_by_minutes
-
-    def _init_stats(self):
-        self.start_time = self.points[0].time
-        self.end_time = self.points[self.len - 1].time
-        self.total_time = self.end_time - self.start_time
-
-        self._total_distance = self.dist_from_start[-1]
-        self.avg_speed = self._total_distance / self.total_time.total_seconds() * 3600
-
-        self.max_speed = max(self.speed)
+        return normalize_by_filters(normalized_by_minutes, self.norm_params)
 
     def print_stats(self):
         print('Track %s' % self.name)
@@ -183,53 +339,64 @@ class Track:
         print(self.speed_params)
         print(self.norm_params)
 
-    def find_point_index(self, point_to_check):
-        for i in range(self.len):
-            if get_dist(point_to_check, self.points[i]) < POINT_DISTANCE_THRESHOLD_KM:
-                return i
-
-        return None
+    @lazy_property
+    def spatial_index(self):
+        """Grid index over track points, cropped tracks use restricted index of the root track"""
+        if self._crop_root is not None:
+            return self._crop_root.spatial_index.restricted(self._crop_start, self._crop_start + self.len)
+        return TrackSpatialIndex(self.lat, self.lon)
+
+    def find_point_index(self, point_to_check, start_idx=0):
+        """@:returns index of the first point after start_idx closer than POINT_DISTANCE_THRESHOLD_KM or None"""
+        return self.spatial_index.first_within(
+            point_to_check.lat, point_to_check.lon, POINT_DISTANCE_THRESHOLD_KM, start_idx
+        )
 
     def crop_to_point_idx(self, index):
         if index < 0 or index >= self.len:
             print("Invalid point index for cropping!")
             return self
         else:
-            return Track(
-                self.name,
-                self.points[:index],
-                self.speed_params,
-                self.norm_params
-            )
+            return self._crop(self.name, 0, index)
 
     def crop_from_point_idx(self, index):
         if index < 0 or index >= self.len:
             print("Invalid point index for cropping!")
             return self
         else:
-            return Track(
-                self.name,
-                self.points[index:],
-                self.speed_params,
-                self.norm_params
-            )
+            return self._crop(self.name, index, self.len)
 
     def crop_to_activity_segment(self, activity_segment, segment_name):
-        return Track(
-            segment_name,
-            self.points[activity_segment.start_idx:activity_segment.end_idx + 1],
-            self.speed_params,
-            self.norm_params
-        )
+        return self._crop(segment_name, activity_segment.start_idx, activity_segment.end_idx + 1)
 
     def crop_to_activity_segment_start(self, activity_segment, segment_name):
         """Here we use only start point of activity segment. There can be several stops on road"""
-        return Track(
-            segment_name,
-            self.points[activity_segment.start_idx:],
-            self.speed_params,
-            self.norm_params
-        )
+        return self._crop(segment_name, activity_segment.start_idx, self.len)
+
+    def _crop(self, name, start, end):
+        """
+        Cropped track reuses normalized points and calculated values of this track. Only minute start alignment is
+        applied again, it adds a single point copy when crop doesn't start at the minute start
+        """
+        if self.norm_params.align_to_minutes and start > 0:
+            aligned_points = normalize_minute_starts(self.points[start:end])
+            if len(aligned_points) > end - start:
+                speed = np.concatenate([self.speed[start:start + 1], self.speed[start:end]])
+                return Track.from_normalized_points(
+                    name, aligned_points, self.speed_params, self.norm_params, speed=speed
+                )
+
+        if self._crop_root is None:
+            root, root_start = self, start
+        else:
+            root, root_start = self._crop_root, self._crop_start + start
+
+        track = Track.__new__(Track)
+        track.name = name
+        track._speed_params = self.speed_params
+        track.norm_params = self.norm_params
+        track._init_points(root.points[root_start:root_start + end - start], root, root_start)
+        return track
 
 
 class TrackActivitySegment:
@@ -1,7 +1,6 @@
 from collections import namedtuple
-from collections import deque
-import math
-from gpstools.utils import get_bearing_diff, sign
+
+import numpy as np
 
 TrackProfileParams = namedtuple('TrackProfileParams', ['straight_degrees_bounds', 'window_size_min_points'])
 
@@ -45,45 +44,76 @@ class TrackProfile:
         self.segments = []
 
 
-def build_track_profile(track, params):
-    point_window = deque()
-    last_segment = None
-    segments = []
-
-    def update_point_window(idx, point):
-        point_window.append((idx, point))
-        if len(point_window) > params.window_size_min_points:
-            point_window.popleft()
-
-    def get_segment_suggestion():
-        min_bearing, max_bearing, total_bearing = 500, -500, 0
-        for idx, p in point_window:
-            total_bearing += p.bearing
-            if p.bearing < min_bearing:
-                min_bearing = p.bearing
-            if p.bearing > max_bearing:
-                max_bearing = p.bearing
-
-        avg_bearing = total_bearing / len(point_window)
-        if math.fabs(get_bearing_diff(avg_bearing, min_bearing)) < params.straight_degrees_bounds and \
-                math.fabs(get_bearing_diff(avg_bearing, max_bearing)) < params.straight_degrees_bounds:
-            return StraightProfileSegment(point_window[0][0], None, avg_bearing)
-        else:
-            return TurnProfileSegment(
-                point_window[0][0],
-                None,
-                sign(get_bearing_diff(point_window[0][1].bearing, point_window[-1][1].bearing))
-            )
-
+def build_track_profile(track, params=DEFAULT_TRACK_PROFILE_PARAMS):
+    """
+    Splits track into straights and turns. Each point is classified by the window of last window_size_min_points
+    bearings: window is straight when all its bearings are within straight_degrees_bounds from their circular mean.
+    Segment changes where classification changes, all steps are linear in number of points
+    @:returns TrackProfile or None for tracks without bearing data
+    """
     if not track.has_bearing_data:
         print('Cannot build profile for track with no bearing data!')
         return None
 
+    profile = TrackProfile()
+    if track.len == 0:
+        return profile
+
+    window_size = params.window_size_min_points
+    bearings = np.asarray(track.points.bearing, dtype=np.float64)
+
+    # Unwrapped bearings are continuous over 0/360 mark, so min and max are meaningful for any window
+    bearing_steps = _get_bearing_diffs(bearings[:-1], bearings[1:])
+    unwrapped = np.concatenate([[bearings[0]], bearings[0] + np.cumsum(bearing_steps)])
+
+    # Windows at the track start are shorter, they contain all points from the start
+    mean_bearings = np.degrees(np.arctan2(
+        _rolling_sum(np.sin(np.radians(bearings)), window_size),
+        _rolling_sum(np.cos(np.radians(bearings)), window_size)
+    ))
+    unwrapped_means = unwrapped + _get_bearing_diffs(bearings, mean_bearings)
+    window_min = _rolling_extremum(unwrapped, window_size, np.minimum, np.inf)
+    window_max = _rolling_extremum(unwrapped, window_size, np.maximum, -np.inf)
+
+    is_straight = (unwrapped_means - window_min < params.straight_degrees_bounds) & \
+        (window_max - unwrapped_means < params.straight_degrees_bounds)
+
+    segment_starts = np.flatnonzero(np.concatenate([[True], is_straight[1:] != is_straight[:-1]]))
+    segment_ends = np.append(segment_starts[1:] - 1, track.len - 1)
+    for start_idx, end_idx in zip(segment_starts.tolist(), segment_ends.tolist()):
+        if is_straight[start_idx]:
+            bearing = float(np.mean(unwrapped[start_idx:end_idx + 1]) % 360)
+            profile.segments.append(StraightProfileSegment(start_idx, end_idx, bearing))
+        else:
+            rotation = int(np.sign(unwrapped[end_idx] - unwrapped[start_idx]))
+            profile.segments.append(TurnProfileSegment(start_idx, end_idx, rotation))
+
+    return profile
+
+
+def _get_bearing_diffs(bearings1, bearings2):
+    """Array version of get_bearing_diff, diffs are in [-180, 180)"""
+    return (bearings2 - bearings1 + 180) % 360 - 180
+
+
+def _rolling_sum(values, window_size):
+    """Sums of windows ending at each value"""
+    cumulative = np.concatenate([[0.0], np.cumsum(values)])
+    starts = np.maximum(np.arange(1, len(values) + 1) - window_size, 0)
+    return cumulative[1:] - cumulative[starts]
+
 
+def _rolling_extremum(values, window_size, func, fill_value):
+    """
+    Rolling min or max (func is np.minimum or np.maximum) of windows ending at each value. Calculated with van Herk /
+    Gil-Werman blocks: window is covered by suffix of one block and prefix of the next one
+    """
+    n = len(values)
+    blocks_count = (n + window_size - 1) // window_size + 1
+    padded = np.full(blocks_count * window_size, fill_value)
+    padded[window_size - 1:window_size - 1 + n] = values
 
-    for i, point in enumerate(track.points):
-        update_point_window(i, point)
-        suggestion = get_segment_suggestion()
-        if last_segment is None:
-            last_segment = suggestion
-        elif last_segment.type != suggestion.type:
+    blocks = padded.reshape(blocks_count, window_size)
+    prefix = func.accumulate(blocks, axis=1).ravel()
+    suffix = func.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return func(suffix[:n], prefix[window_size - 1:window_size - 1 + n])
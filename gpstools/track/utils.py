@@ -1,26 +1,41 @@
-import haversine
+import numpy as np
 
 from gpstools.config import SPARSE_TRACK_DISTANCE_THRESHOLD_KM
 from gpstools.track.track import Track
+from gpstools.utils import get_dists
 
+# Number of points after the last reference point checked at once
+SPARSE_TRACK_SEARCH_CHUNK_SIZE = 64
 
-def build_sparse_track(track, distance_threshold=SPARSE_TRACK_DISTANCE_THRESHOLD_KM):
-    last_point = track.points[0]
-    reference_points = [last_point]
-
-    for point in track.points:
-        dist = haversine.haversine(
-            (point.lat, point.lon),
-            (last_point.lat, last_point.lon)
-        )
-
-        if dist > distance_threshold:
-            reference_points.append(point)
-            last_point = point
 
+def build_sparse_track(track, distance_threshold=SPARSE_TRACK_DISTANCE_THRESHOLD_KM):
     return Track(
         name=track.name,
-        points=reference_points,
+        points=track.points[get_sparse_track_indices(track, distance_threshold)],
         speed_params=track.speed_params,
         norm_params=track.norm_params
     )
+
+
+def get_sparse_track_indices(track, distance_threshold=SPARSE_TRACK_DISTANCE_THRESHOLD_KM):
+    """@:returns indices of points farther than distance_threshold from the previous selected point, starting with 0"""
+    last_idx = 0
+    reference_indices = [last_idx]
+
+    search_idx = 1
+    while search_idx < track.len:
+        chunk_end = min(search_idx + SPARSE_TRACK_SEARCH_CHUNK_SIZE, track.len)
+        dists = get_dists(
+            track.lat[search_idx:chunk_end], track.lon[search_idx:chunk_end],
+            track.lat[last_idx], track.lon[last_idx]
+        )
+
+        far_indices = np.flatnonzero(dists > distance_threshold)
+        if len(far_indices) == 0:
+            search_idx = chunk_end
+        else:
+            last_idx = search_idx + int(far_indices[0])
+            reference_indices.append(last_idx)
+            search_idx = last_idx + 1
+
+    return np.array(reference_indices)
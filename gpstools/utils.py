@@ -1,6 +1,12 @@
 import haversine
+import numpy as np
+from datetime import datetime, timedelta, timezone
 from math import sin, cos, atan2, acos, radians, degrees, sqrt, fabs
 
+EPOCH = datetime(1970, 1, 1)
+MICROS_IN_SECOND = 1000000
+MICROS_IN_MINUTE = 60 * MICROS_IN_SECOND
+
 
 def avg(l):
     assert len(l) > 0
@@ -45,6 +51,26 @@ def get_timedelta_micros(time1, time2):
     return time_delta.seconds * 1000000 + time_delta.microseconds
 
 
+def get_fixed_tzinfo(time):
+    """Returns fixed-offset timezone of a datetime (or None for naive ones), used as a timezone of a whole track"""
+    if time.tzinfo is None:
+        return None
+    return timezone(time.utcoffset())
+
+
+# Converts datetime to wall-clock microseconds since epoch in given track timezone
+def datetime_to_micros(time, tzinfo=None):
+    if tzinfo is not None:
+        time = time.astimezone(tzinfo)
+    time_delta = time.replace(tzinfo=None) - EPOCH
+    return (time_delta.days * 86400 + time_delta.seconds) * MICROS_IN_SECOND + time_delta.microseconds
+
+
+# Converts wall-clock microseconds since epoch back to datetime in given track timezone
+def micros_to_datetime(micros, tzinfo=None):
+    return (EPOCH + timedelta(microseconds=int(micros))).replace(tzinfo=tzinfo)
+
+
 # Calculates haversine dist between two TrackPoint or Coords objects
 def get_dist(point1, point2):
     return haversine.haversine(
@@ -56,6 +82,29 @@ def get_dist(point1, point2):
 EARTH_RADIUS = 6371.0088
 
 
+def get_dists(lat1, lon1, lat2, lon2):
+    """
+    Vectorized haversine dist in km between arrays of coordinates (same formula and earth radius as haversine package).
+    Arguments are broadcasted, so it covers pairwise, point-to-array and array-to-array (matrix) cases
+    """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    d = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2
+    return 2 * np.arcsin(np.sqrt(d)) * EARTH_RADIUS
+
+
+def get_dists_to_point(point, lat, lon):
+    """Calculates haversine dists from TrackPoint or Coords object to each of given coordinates"""
+    return get_dists(point.lat, point.lon, lat, lon)
+
+
+def get_consecutive_dists(lat, lon):
+    """Calculates haversine dists between each point and the previous one, first dist is zero"""
+    dists = np.zeros(len(lat))
+    if len(lat) > 1:
+        dists[1:] = get_dists(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    return dists
+
+
 # Calculates bearing in degrees from point to point
 def get_bearing(coords1, coords2):
     lat1, lon1, lat2, lon2 = map(radians, (coords1.lat, coords1.lon, coords2.lat, coords2.lon))
@@ -94,6 +143,30 @@ def sign(x):
         return 0
 
 
+class lazy_property:
+    """
+    Property computed on first access and cached in instance dict, so further access is a plain attribute lookup.
+    Cached value is dropped with invalidate_lazy_properties
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.func(instance)
+        instance.__dict__[self.name] = value
+        return value
+
+
+def invalidate_lazy_properties(instance, names):
+    for name in names:
+        instance.__dict__.pop(name, None)
+
+
 def print_tracks_stats(tracks):
     print("Total %d tracks" % len(tracks))
     for i in range(len(tracks)):
@@ -1,9 +1,11 @@
 import json
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 import random
 import shutil
 import string
+from collections import namedtuple
 from jinja2 import Environment, PackageLoader
 
 import gpstools
@@ -18,6 +20,9 @@ GRAPH_HTML_FILE = 'graph.html'
 GRAPH_JS_FILE = 'graph.js'
 GRAPH_DATA_FILE = 'data.json'
 
+# Already serialized json value, inserted into output of _dumps_json_object as it is
+RawJson = namedtuple('RawJson', ['text'])
+
 
 def plot_distance_speed_graph(tracks):
     fig = plt.figure()
@@ -80,7 +85,7 @@ def generate_reference_selection_graph(tracks):
                     'idx': i,
                     'x': track.dist_from_start[i],
                     'y': track.speed[i],
-                    'micros': track.micros_from_start[i]
+                    'micros': int(track.micros_from_start[i])
                 })
 
             tracks_json.append({
@@ -146,7 +151,8 @@ def _output_tracks_map_json(filename, tracks):
 
 
 # Generates separate folder with html and js to show
-def generate_ss_analysis_graph(name, graph_title, reference_track, tracks, speed_comparison_points):
+def generate_ss_analysis_graph(name, graph_title, reference_track, tracks, speed_comparison_points,
+                               tracks_data_json=None):
     graph_path = os.path.join(GRAPH_OUTPUT_PATH, name)
     module_path = os.path.dirname(gpstools.__file__)
 
@@ -154,36 +160,58 @@ def generate_ss_analysis_graph(name, graph_title, reference_track, tracks, speed
     shutil.copytree(os.path.join(module_path, 'resources', 'speed_comparison'), graph_path)
 
     # Using first track to build track on map
-    _output_ss_comparison_json(os.path.join(graph_path, GRAPH_DATA_FILE), graph_title,
-                               reference_track, tracks, speed_comparison_points)
+    output_ss_comparison_json(os.path.join(graph_path, GRAPH_DATA_FILE), graph_title,
+                               reference_track, tracks, speed_comparison_points, tracks_data_json)
+
+
+# Rewrites data of the graph generated by generate_ss_analysis_graph
+def update_ss_analysis_graph(name, graph_title, reference_track, tracks, speed_comparison_points,
+                             tracks_data_json=None):
+    output_ss_comparison_json(os.path.join(GRAPH_OUTPUT_PATH, name, GRAPH_DATA_FILE), graph_title,
+                               reference_track, tracks, speed_comparison_points, tracks_data_json)
+
+
+def get_ss_track_data_json(track):
+    """Serialized points of aligned track, the largest part of comparison json, so it can be cached with the track"""
+    data = []
+    for i, point in enumerate(track.points):
+        data.append({
+            'x': point.dist,
+            'y': point.speed,
+            'lat': point.lat,
+            'lon': point.lon,
+            'idx': i,
+            'micros': point.micros
+        })
+    return json.dumps(data)
+
+
+def output_ss_comparison_json(filename, title, reference_track, tracks, speed_comparison_points,
+                              tracks_data_json=None):
+    """
+    Writes data file of speed comparison graph
+    @:param tracks_data_json - optional list of get_ss_track_data_json results for tracks, calculated when not given
+    """
+    if tracks_data_json is None:
+        tracks_data_json = [get_ss_track_data_json(track) for track in tracks]
 
-def _output_ss_comparison_json(filename, title, reference_track, tracks, speed_comparison_points):
     with open(filename, "w+") as json_file:
         tracks_json = []
         for i in range(len(tracks)):
             track = tracks[i]
             color_code = COLOR_CODES[i]
-            data = []
-            for i, point in enumerate(track.points):
-                data.append({
-                    'x': point.dist,
-                    'y': point.speed,
-                    'lat': point.lat,
-                    'lon': point.lon,
-                    'idx': i,
-                    'micros': point.micros
-                })
 
-            tracks_json.append({
+            # Points data is inserted already serialized
+            tracks_json.append(_dumps_json_object({
                 "name": track.name,
                 "duration": track.points[-1].micros,
                 "max_speed": track.max_speed,
                 "avg_speed": track.avg_speed,
                 "finished": track.is_finished,
                 "color": color_code,
-                "data": data,
+                "data": RawJson(tracks_data_json[i]),
                 "line_width": 1.0 if not track.subsecond_precision else 0.5
-            })
+            }))
 
         map_points_json = []
         for point in reference_track.points:
@@ -200,12 +228,48 @@ def _output_ss_comparison_json(filename, title, reference_track, tracks, speed_c
                 'speeds': point.speeds
             })
 
+        json_file.write(_dumps_json_object({
+            "title": title,
+            "tracks": RawJson('[%s]' % ', '.join(tracks_json)),
+            "map_points": map_points_json,
+            "speed_points": speed_points_json
+        }))
+
+
+def _dumps_json_object(fields):
+    """Serializes dict into json object, RawJson values are inserted without serialization"""
+    return '{%s}' % ', '.join(
+        '%s: %s' % (json.dumps(key), value.text if isinstance(value, RawJson) else json.dumps(value))
+        for key, value in fields.items()
+    )
+
+
+def output_resampled_comparison_json(filename, title, resampled_tracks):
+    """
+    Compact comparison data of ResampledTracks: values of all tracks on the common distance grid instead of points,
+    times are rounded to milliseconds and speeds to 0.01 kph, values not reached by tracks are null
+    """
+    def to_json_values(values, digits):
+        rounded = np.round(values, digits)
+        return [None if np.isnan(value) else value for value in rounded.tolist()]
+
+    tracks_json = []
+    for i, name in enumerate(resampled_tracks.names):
+        tracks_json.append({
+            "name": name,
+            "finished": resampled_tracks.finished[i],
+            "color": COLOR_CODES[i % len(COLOR_CODES)],
+            "time": to_json_values(resampled_tracks.time[i], 3),
+            "speed": to_json_values(resampled_tracks.speed[i], 2)
+        })
+
+    with open(filename, "w+") as json_file:
         json.dump(
             {
                 "title": title,
-                "tracks": tracks_json,
-                "map_points": map_points_json,
-                "speed_points": speed_points_json
+                "dist": to_json_values(resampled_tracks.dist, 4),
+                "reference_time": to_json_values(resampled_tracks.reference_time, 3),
+                "tracks": tracks_json
             },
             json_file
         )